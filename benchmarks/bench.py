@@ -0,0 +1,159 @@
+"""Benchmarks for the libtivomind client hot paths, run against a local MockMindServer.
+
+    python benchmarks/bench.py --output results-0.13.0.json
+    python benchmarks/bench.py --compare results-0.13.0.json
+
+A self-signed certificate is generated with the openssl command line tool unless --cert is
+given; it must be a PEM file holding both the certificate and its unencrypted private key, and
+is used by the server and as the client certificate.  Each benchmark reports the median of
+--repeat runs.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import libtivomind
+import libtivomind.api as api
+import libtivomind.mockserver as mockserver
+import libtivomind.rpc as rpc
+
+
+def make_certificate(directory):
+    cert_path = os.path.join(directory, 'cert.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-subj', '/CN=localhost', '-keyout', cert_path, '-out', cert_path],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert_path
+
+
+def median_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+class Benchmarks(object):
+
+    def __init__(self, cert_path, repeat=5, latency=0.0):
+        self.cert_path = cert_path
+        self.repeat = repeat
+        self.latency = latency
+        self.socket_maker = rpc.SocketMaker(cert_path, None)
+
+    def server(self, **kwargs):
+        kwargs.setdefault('latency', self.latency)
+        return mockserver.MockMindServer(self.cert_path, **kwargs)
+
+    def mind(self, server, **kwargs):
+        session = rpc.MRPCSession(self.socket_maker, '127.0.0.1', rpc.MRPCCredential.new_mak('0'), port=server.port)
+        session.connect()
+        return api.Mind(session, **kwargs)
+
+    def bench_connect(self):
+        with self.server() as server:
+            def connect():
+                session = rpc.MRPCSession(self.socket_maker, '127.0.0.1', rpc.MRPCCredential.new_mak('0'),
+                                          port=server.port)
+                session.connect()
+                session.close()
+            return {'connect_auth_s': median_time(connect, self.repeat)}
+
+    def bench_single_rpc(self, calls=200):
+        with self.server() as server:
+            mind = self.mind(server)
+            seconds = median_time(lambda: [mind.send_key(api.RemoteKey.info) for _ in range(calls)], self.repeat)
+            mind.session.close()
+            return {'single_rpc_latency_s': seconds / calls}
+
+    def bench_paged(self, items=5000, count=50, item_size=200):
+        results = {}
+        with self.server(items=items, item_size=item_size) as server:
+            for window in (1, 8):
+                mind = self.mind(server, page_window=window)
+                seconds = median_time(lambda: mind.offer_search(count=count, fetch_all=True), self.repeat)
+                mind.session.close()
+                results['fetch_all_items_per_s_window_{:d}'.format(window)] = items / seconds
+        return results
+
+    def bench_frame_parse(self, frames=200, items=50, item_size=200):
+        server = self.server(items=items, item_size=item_size)
+        frame = server.encode_response({'RpcId': '1'}, 'offerList', server.search('offerSearch', {'count': items}))
+        data = frame * frames
+
+        class Source(object):
+            def __init__(self):
+                self.view = memoryview(data)
+                self.pos = 0
+
+            def recv_into(self, buffer):
+                n = min(len(buffer), 16384, len(data) - self.pos)
+                buffer[:n] = self.view[self.pos:self.pos + n]
+                self.pos += n
+                return n
+
+        codec = rpc.default_codec()
+
+        def parse():
+            source = Source()
+            decoder = rpc.MRPCFrameDecoder()
+            for _ in range(frames):
+                headers, body = decoder.read_frame(source)
+                codec.loads(body)
+
+        seconds = median_time(parse, self.repeat)
+        return {'frame_parse_s': seconds / frames, 'frame_parse_mb_per_s': len(data) / seconds / 1e6}
+
+    def run(self, selected=None):
+        results = {}
+        for name in ('connect', 'single_rpc', 'paged', 'frame_parse'):
+            if selected is None or name in selected:
+                results.update(getattr(self, 'bench_' + name)())
+        return results
+
+
+def compare(results, baseline):
+    print('{:<36} {:>14} {:>14} {:>8}'.format('benchmark', 'baseline', 'current', 'ratio'))
+    for name, value in sorted(results.items()):
+        old = baseline.get('results', {}).get(name)
+        ratio = '' if not old else '{:.2f}'.format(value / old)
+        print('{:<36} {:>14.6g} {:>14.6g} {:>8}'.format(name, old if old else float('nan'), value, ratio))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--cert', help='PEM certificate and private key for the mock server and client.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.0, help='Simulated per-reply latency in seconds.')
+    parser.add_argument('--only', nargs='*', choices=['connect', 'single_rpc', 'paged', 'frame_parse'])
+    parser.add_argument('--output', help='Write the results as JSON to this file.')
+    parser.add_argument('--compare', help='A JSON results file from an earlier run to compare against.')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        cert_path = args.cert if args.cert else make_certificate(directory)
+        results = Benchmarks(cert_path, repeat=args.repeat, latency=args.latency).run(args.only)
+
+    report = {'version': libtivomind.__version__, 'python': sys.version.split()[0], 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    else:
+        for name, value in sorted(results.items()):
+            print('{:<36} {:>14.6g}'.format(name, value))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""Stream Mind search results from a TiVo as newline-delimited JSON.
+
+    python -m libtivomind --cert cert.pem --cert-password secret --address 192.168.1.20 --mak 0123456789 \
+        offers --start "2024-01-01 00:00" --end "2024-01-08 00:00" --output guide.ndjson.gz
+
+Results are written page by page as they arrive, so memory use does not grow with the size of the
+result set.  Output goes to stdout unless --output is given, and is compressed with gzip or zstd
+(the latter needs the zstandard package) when asked or when the output file name ends in .gz or
+.zst.  A throughput summary is printed to stderr at the end.
+"""
+import argparse
+import datetime
+import gzip
+import importlib.util
+import json
+import os
+import sys
+import time
+
+import libtivomind.api as api
+
+# Search types on the command line, mapped to the streaming Mind method for each.
+SEARCHES = {'channels': 'iter_channels',
+            'recordings': 'iter_recordings',
+            'recording-folder-items': 'iter_recording_folder_items',
+            'offers': 'iter_offers',
+            'content': 'iter_content',
+            'collections': 'iter_collections',
+            'categories': 'iter_categories'}
+
+
+def parse_time(value):
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("{!r} is not a UTC time like 2024-01-01 18:30.".format(value))
+
+
+def parse_field(value):
+    if '=' not in value:
+        raise argparse.ArgumentTypeError("{!r} is not FIELD=VALUE.".format(value))
+    field, text = value.split('=', 1)
+    try:
+        return field, json.loads(text)
+    except ValueError:
+        return field, text
+
+
+def compression_for(args):
+    if args.compress is not None:
+        return args.compress
+    if args.output.endswith('.gz'):
+        return 'gzip'
+    if args.output.endswith('.zst'):
+        return 'zstd'
+    return 'none'
+
+
+def open_output(path, compression):
+    """Return (stream to write to, list of streams to close afterwards, innermost first)."""
+    raw = sys.stdout.buffer if path == '-' else open(path, 'wb')
+    owned = [] if path == '-' else [raw]
+    if compression == 'gzip':
+        stream = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6)
+        return stream, [stream] + owned
+    if compression == 'zstd':
+        import zstandard
+        stream = zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+        return stream, [stream] + owned
+    return raw, owned
+
+
+def build_filter(args, search):
+    filt = api.SearchFilter()
+    if search == 'offers' and (args.start is not None or args.end is not None):
+        filt.by_start_time(args.start, args.end)
+    if args.field:
+        filt.by_user_fields(dict(args.field))
+    return filt
+
+
+def export(mind, searches, filters, stream, page_size, limit=None):
+    """Write the results of each search, narrowed by filters[search], to stream as NDJSON; returns
+    (items, bytes) written."""
+    codec = mind.session.codec
+    items = 0
+    written = 0
+    for search in searches:
+        results = getattr(mind, SEARCHES[search])(filt=filters[search], count=page_size)
+        try:
+            for item in results:
+                line = codec.dumps(item) + b'\n'
+                stream.write(line)
+                items += 1
+                written += len(line)
+                if limit is not None and items >= limit:
+                    return items, written
+        finally:
+            results.close()
+    return items, written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m libtivomind', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('searches', nargs='+', choices=sorted(SEARCHES), metavar='SEARCH',
+                        help='One or more of: {}.'.format(', '.join(sorted(SEARCHES))))
+    parser.add_argument('--cert', required=True, help='Client certificate and private key, in one PEM file.')
+    parser.add_argument('--cert-password', default=os.environ.get('TIVO_CERT_PASSWORD'),
+                        help='Certificate password (default: $TIVO_CERT_PASSWORD).')
+    parser.add_argument('--address', required=True, help='Address of the TiVo.')
+    parser.add_argument('--mak', default=os.environ.get('TIVO_MAK'), help="The TiVo's MAK (default: $TIVO_MAK).")
+    parser.add_argument('--port', type=int, default=1413)
+    parser.add_argument('--output', '-o', default='-', help='Output file, or - for stdout (the default).')
+    parser.add_argument('--compress', choices=['none', 'gzip', 'zstd'],
+                        help='Compression (default: from the output file name, else none).')
+    parser.add_argument('--page-size', type=int, default=50, help='Results per request.')
+    parser.add_argument('--window', type=int, default=4, help='Pages requested ahead of the one being written.')
+    parser.add_argument('--level-of-detail', default='medium', choices=['low', 'medium', 'high'])
+    parser.add_argument('--start', type=parse_time, help='Earliest start time (UTC) of offers.')
+    parser.add_argument('--end', type=parse_time, help='Latest start time (UTC) of offers.')
+    parser.add_argument('--field', type=parse_field, action='append', metavar='FIELD=VALUE',
+                        help='Extra search criteria; VALUE is parsed as JSON if possible.  May be repeated.')
+    parser.add_argument('--limit', type=int, help='Stop after this many results.')
+    parser.add_argument('--quiet', '-q', action='store_true', help='Do not print the summary.')
+    args = parser.parse_args(argv)
+    if args.mak is None:
+        parser.error('--mak (or $TIVO_MAK) is required.')
+    if (args.start is not None or args.end is not None) and 'offers' not in args.searches:
+        parser.error('--start and --end only apply to offers.')
+    compression = compression_for(args)
+    if compression == 'zstd' and importlib.util.find_spec('zstandard') is None:
+        parser.error('zstd compression needs the zstandard package.')
+
+    start = time.monotonic()
+    mind = api.Mind.new_local_session(cert_path=args.cert,
+                                      cert_password=args.cert_password,
+                                      address=args.address,
+                                      mak=args.mak,
+                                      port=args.port)
+    mind.level_of_detail = args.level_of_detail
+    mind.page_window = args.window
+    stream, owned = open_output(args.output, compression)
+    try:
+        filters = {search: build_filter(args, search) for search in args.searches}
+        items, written = export(mind, args.searches, filters, stream, args.page_size, limit=args.limit)
+    finally:
+        for closing in owned:
+            closing.close()
+        if args.output == '-':
+            sys.stdout.buffer.flush()
+        mind.session.close()
+    elapsed = max(time.monotonic() - start, 1e-9)
+    if not args.quiet:
+        print("{:,d} items, {:,.1f} kB of NDJSON in {:.2f} s ({:,.0f} items/s, {:,.1f} kB/s)".format(
+            items, written / 1e3, elapsed, items / elapsed, written / 1e3 / elapsed), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
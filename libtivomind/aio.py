@@ -0,0 +1,402 @@
+import asyncio
+import logging
+
+import libtivomind.api as api
+import libtivomind.rpc as rpc
+
+log = logging.getLogger(__name__)
+
+
+class AsyncMRPCSubscription(object):
+    """The asyncio counterpart of rpc.MRPCSubscription, iterated with ``async for``."""
+
+    __done = object()
+
+    def __init__(self, session, req_type, rpc_id, callback=None):
+        self.session = session
+        self.req_type = req_type
+        self.rpc_id = rpc_id
+        self.callback = callback
+        self.active = True
+        self.error = None
+        self.queue = asyncio.Queue()
+
+    def _deliver(self, headers, body):
+        if not self.active:
+            return
+        if self.callback is not None:
+            self.callback(body)
+        else:
+            self.queue.put_nowait(body)
+        if headers.get('IsFinal') == 'true':
+            self._finish()
+
+    def _finish(self, error=None):
+        if self.active:
+            self.active = False
+            self.error = error
+            self.queue.put_nowait(self.__done)
+
+    def cancel(self):
+        self.session.unsubscribe(self.rpc_id)
+        self._finish()
+
+    async def get(self, timeout=None):
+        try:
+            body = await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            raise rpc.MRPCTimeout("No event on RpcId {:d} within {} seconds.".format(self.rpc_id, timeout))
+        if body is self.__done:
+            self.queue.put_nowait(body)
+            if self.error is not None:
+                raise self.error
+            raise StopAsyncIteration
+        return body
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get()
+
+
+class AsyncMRPCSession(rpc.MRPCProtocol):
+    """An asyncio MRPC session.
+
+    A single reader task owns the receive side of the connection and resolves the future
+    registered for each RpcId, so any number of requests may be outstanding at once."""
+
+    def __init__(self, socket_maker, address, credential, port=1413, debug=False, read_size=65536):
+        super().__init__(socket_maker, address, credential, port=port, debug=debug)
+        self.read_size = read_size
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.futures = {}
+        self.subscriptions = {}
+
+    async def connect(self):
+        self.decoder.reset()
+        self.reader, self.writer = await asyncio.open_connection(self.address, self.port, ssl=self.sm.ctx)
+        self._observe_connect()
+        self.reader_task = asyncio.ensure_future(self.__read_loop())
+        auth_id = await self.send_request("bodyAuthenticate", self.credential.payload())
+        body_id = self.cached_body_id() if self.credential.cred_type == "MAK_CREDENTIAL" else None
+        config_id = None
+        if self.credential.cred_type == "MAK_CREDENTIAL" and body_id is None:
+            config_id = await self.send_request("bodyConfigSearch", {"bodyId": "-"})
+        h, b = await self.get_response(auth_id)
+        try:
+            self.check_auth(b)
+        except rpc.MRPCError:
+            await self.close()
+            raise
+        if self.credential.cred_type == "WEB_CREDENTIAL":
+            self.body_id = self.web_body_id(b)
+        elif config_id is not None:
+            h, r = await self.get_response(config_id)
+            self.body_id = self.config_body_id(r)
+            self.remember_body_id(self.body_id)
+        else:
+            self.body_id = body_id
+
+    async def close(self):
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            try:
+                await self.reader_task
+            except asyncio.CancelledError:
+                pass
+            self.reader_task = None
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (OSError, rpc.MRPCError):
+                pass
+            self.writer = None
+            self.reader = None
+        self.__fail_pending(rpc.MRPCError("Session closed."))
+
+    def __fail_pending(self, exc):
+        for future in self.futures.values():
+            if not future.done():
+                future.set_exception(exc)
+        subscriptions, self.subscriptions = self.subscriptions, {}
+        for subscription in subscriptions.values():
+            subscription._finish(exc)
+
+    async def __read_loop(self):
+        try:
+            while True:
+                data = await self.reader.read(self.read_size)
+                if not data:
+                    raise rpc.MRPCError("Connection closed by remote host.")
+                self.decoder.feed(data)
+                frame = self.decoder.next_frame()
+                while frame is not None:
+                    headers, body = frame
+                    if self.debug:
+                        log.debug("RPC Response ID: %s", headers['RpcId'])
+                    rpc_id = int(headers['RpcId'])
+                    subscription = self.subscriptions.get(rpc_id)
+                    if subscription is not None:
+                        self.__deliver(subscription, headers, body)
+                    future = self.futures.get(rpc_id)
+                    if future is not None and not future.done():
+                        future.set_result((headers, self._decode_response(headers, body)))
+                    elif subscription is None:
+                        self._observe_dropped(rpc_id)
+                    frame = self.decoder.next_frame()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.__fail_pending(e if isinstance(e, rpc.MRPCError) else rpc.MRPCError(str(e)))
+
+    async def send_request(self, req_type, payload_json, multiple_responses=False):
+        if self.writer is None:
+            raise rpc.MRPCError("Session is not connected.")
+        if self.observer is None:
+            rpc_id, request = self.encode_request(req_type, payload_json, multiple_responses)
+        else:
+            rpc_id, request = self._encode_observed(req_type, payload_json, multiple_responses)
+        self.futures[rpc_id] = asyncio.get_running_loop().create_future()
+        self.writer.write(request)
+        await self.writer.drain()
+        return rpc_id
+
+    def __deliver(self, subscription, headers, body):
+        try:
+            subscription._deliver(headers, self._decode_response(headers, body))
+        except Exception as e:
+            subscription._finish(e if isinstance(e, rpc.MRPCError) else rpc.MRPCError(repr(e)))
+        if not subscription.active:
+            self.unsubscribe(subscription.rpc_id)
+
+    async def subscribe(self, req_type, payload_json, callback=None):
+        if self.writer is None:
+            raise rpc.MRPCError("Session is not connected.")
+        if self.observer is None:
+            rpc_id, request = self.encode_request(req_type, payload_json, True)
+        else:
+            rpc_id, request = self._encode_observed(req_type, payload_json, True)
+        subscription = AsyncMRPCSubscription(self, req_type, rpc_id, callback=callback)
+        self.subscriptions[rpc_id] = subscription
+        self.writer.write(request)
+        await self.writer.drain()
+        return subscription
+
+    def cancel(self, rpc_id):
+        """Abandon a request: its reply is dropped when it arrives."""
+        future = self.futures.pop(rpc_id, None)
+        if future is None:
+            return
+        if not future.done():
+            future.cancel()
+        elif not future.cancelled():
+            # Mark a failure as retrieved so asyncio does not log it.
+            future.exception()
+
+    def unsubscribe(self, rpc_id):
+        self.subscriptions.pop(rpc_id, None)
+
+    async def get_response(self, rpcid, timeout=None):
+        try:
+            return await asyncio.wait_for(self.futures[rpcid], timeout)
+        finally:
+            self.futures.pop(rpcid, None)
+
+    async def request(self, req_type, payload_json, timeout=None):
+        rpc_id = await self.send_request(req_type, payload_json)
+        return await self.get_response(rpc_id, timeout=timeout)
+
+    async def do_auth(self):
+        return await self.request("bodyAuthenticate", self.credential.payload())
+
+    @staticmethod
+    def new_session(cert_path, cert_password, address, credential, port=1413, debug=False):
+        sm = rpc.SocketMaker.shared(cert_path=cert_path, cert_password=cert_password)
+        return AsyncMRPCSession(socket_maker=sm,
+                                address=address,
+                                credential=credential,
+                                port=port,
+                                debug=debug)
+
+    @staticmethod
+    def new_local_session(cert_path, cert_password, address, mak, port=1413, debug=False):
+        cred = rpc.MRPCCredential.new_mak(mak=mak)
+        return AsyncMRPCSession.new_session(cert_path=cert_path,
+                                            cert_password=cert_password,
+                                            address=address,
+                                            credential=cred,
+                                            port=port,
+                                            debug=debug)
+
+    @staticmethod
+    def new_web_session(cert_path, cert_password, username, password, unit_name, debug=False):
+        cred = rpc.MRPCCredential.new_web(username=username, password=password, unit_name=unit_name)
+        return AsyncMRPCSession.new_session(cert_path=cert_path,
+                                            cert_password=cert_password,
+                                            address="middlemind.tivo.com",
+                                            credential=cred,
+                                            port=443,
+                                            debug=debug)
+
+
+class AsyncMind(api.Mind):
+    """A Mind whose search and command methods are coroutines.
+
+    The search methods are inherited from Mind; only the transport-facing methods are replaced,
+    so e.g. ``await mind.offer_search(filt)`` builds exactly the same payload as the blocking client."""
+
+    async def _search(self, search_type, result_type, payload, count=20, offset=0, fetch_all=False):
+        key = self._cache_key(search_type, payload, count, offset, fetch_all)
+        if key is not None:
+            results = self.cache.get(key)
+            if results is not None:
+                return results
+        results = await self._get_paged_response(req_type=search_type,
+                                                 payload=payload,
+                                                 target_array=result_type,
+                                                 count=count,
+                                                 offset=offset,
+                                                 fetch_all=fetch_all)
+        if key is not None:
+            self.cache.put(key, results)
+        return results
+
+    async def _get_paged_response(self, req_type, payload, target_array, count=20, offset=0, fetch_all=False):
+        if fetch_all and self.retry is not None:
+            return await self._get_resumable_response(req_type, payload, target_array, count=count, offset=offset)
+        if fetch_all:
+            return await self._get_pipelined_response(req_type, payload, target_array, count=count,
+                                                      offset=offset, window=self.page_window)
+        payload['count'] = count
+        payload['offset'] = offset
+        h, b = await self.session.request(req_type, payload)
+        return self._page(b, target_array)
+
+    async def _get_pipelined_response(self, req_type, payload, target_array, count=20, offset=0, window=4,
+                                      results=None):
+        results = [] if results is None else results
+        pages = self._page_window(req_type, payload, count, offset + len(results), window)
+        try:
+            while True:
+                while pages.wants():
+                    pages.sent(await self.session.send_request(req_type, pages.request()))
+                h, b = await self.session.get_response(pages.next_id())
+                page = self._page(b, target_array)
+                results.extend(page)
+                if pages.received(h, b, page):
+                    return results
+        finally:
+            pages.close()
+
+    async def _reconnect(self):
+        await self.session.close()
+        await self.session.connect()
+
+    async def _get_resumable_response(self, req_type, payload, target_array, count=20, offset=0):
+        results = []
+        attempt = 0
+        while True:
+            received = len(results)
+            try:
+                return await self._get_pipelined_response(req_type, payload, target_array, count=count,
+                                                          offset=offset, window=self.page_window, results=results)
+            except (OSError, rpc.MRPCError) as e:
+                error = e
+            if len(results) > received:
+                attempt = 0
+            while True:
+                attempt += 1
+                if attempt > self.retry.max_retries:
+                    raise error
+                await asyncio.sleep(self.retry.delay(attempt))
+                self.retry.retried()
+                try:
+                    await self._reconnect()
+                    break
+                except (OSError, rpc.MRPCError) as e:
+                    error = e
+            if results:
+                self.retry.resumed()
+            if 'bodyId' in payload:
+                payload['bodyId'] = self.session.body_id
+
+    async def _iter_paged_response(self, req_type, payload, target_array, count=20, offset=0):
+        pages = self._page_window(req_type, payload, count, offset, self.page_window)
+        try:
+            while True:
+                while pages.wants():
+                    pages.sent(await self.session.send_request(req_type, pages.request()))
+                h, b = await self.session.get_response(pages.next_id())
+                page = self._page(b, target_array)
+                last = pages.received(h, b, page)
+                # Top the window back up before handing over the page, so the next one is already
+                # in flight while the caller works through this one.
+                while pages.wants():
+                    pages.sent(await self.session.send_request(req_type, pages.request()))
+                for item in page:
+                    yield item
+                if last:
+                    return
+        finally:
+            pages.close()
+
+    async def _lookup(self, search_type, result_type, id_field, ids, options, batch_size=50, window=8):
+        semaphore = asyncio.Semaphore(window)
+
+        async def fetch(payload):
+            async with semaphore:
+                h, b = await self.session.request(search_type, payload)
+                return b.get(result_type, [])
+
+        pages = await asyncio.gather(*[fetch(p) for p in self._lookup_batches(search_type, id_field, ids,
+                                                                              options, batch_size)])
+        return {r[id_field]: r for page in pages for r in page if id_field in r}
+
+    async def enrich(self, items, collections=True, content=False, batch_size=50, window=8):
+        if collections:
+            found = await self.collection_lookup(items, batch_size=batch_size, window=window)
+            items = self._attach(items, 'collectionId', 'collection', found)
+        if content:
+            found = await self.content_lookup(items, batch_size=batch_size, window=window)
+            items = self._attach(items, 'contentId', 'content', found)
+        return items
+
+    async def projection_savings(self, search_type, projection, filt=None, count=20):
+        sizes = []
+        for payload in self._projection_payloads(projection, filt, count):
+            h, b = await self.session.request(search_type, payload)
+            sizes.append(h.b_size)
+        return self._projection_savings(*sizes)
+
+    async def _request(self, req_type, payload):
+        h, b = await self.session.request(req_type, payload)
+        return b
+
+    async def close(self):
+        await self.session.close()
+
+    @staticmethod
+    async def new_session(cert_path, cert_password, address, credential, port=1413, debug=False):
+        mrpc = AsyncMRPCSession.new_session(cert_path=cert_path,
+                                            cert_password=cert_password,
+                                            address=address,
+                                            credential=credential,
+                                            port=port,
+                                            debug=debug)
+        await mrpc.connect()
+        return AsyncMind(session=mrpc)
+
+    @staticmethod
+    async def new_local_session(cert_path, cert_password, address, mak, port=1413, debug=False):
+        mrpc = AsyncMRPCSession.new_local_session(cert_path=cert_path,
+                                                  cert_password=cert_password,
+                                                  address=address,
+                                                  mak=mak,
+                                                  port=port,
+                                                  debug=debug)
+        await mrpc.connect()
+        return AsyncMind(session=mrpc)
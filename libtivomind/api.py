@@ -1,8 +1,13 @@
+import collections
 import copy
 import contextlib
 import enum
 import threading
+import time
 
+import libtivomind.coalesce as coalescing
+import libtivomind.paging as paging
+import libtivomind.records as records
 import libtivomind.rpc as rpc
 
 
@@ -88,33 +93,42 @@ class SearchFilter(object):
             self.dict['maxEndTime'] = rpc.MRPCSession.get_date_string(max_utc_time)
 
     def by_category_id(self, category_id):
-        if isinstance(category_id, dict):
+        if isinstance(category_id, records.mapping_types):
             category_id = category_id['categoryId']
         self.dict['categoryId'] = category_id
 
     def by_content_id(self, content_id):
-        if isinstance(content_id, dict):
+        if isinstance(content_id, records.mapping_types):
             content_id = content_id['contentId']
+        elif isinstance(content_id, (list, tuple)):
+            content_id = [c['contentId'] if isinstance(c, records.mapping_types) else c for c in content_id]
         self.dict['contentId'] = content_id
 
     def by_collection_id(self, collection_id):
-        if isinstance(collection_id, dict):
+        if isinstance(collection_id, records.mapping_types):
             collection_id = collection_id['collectionId']
+        elif isinstance(collection_id, (list, tuple)):
+            collection_id = [c['collectionId'] if isinstance(c, records.mapping_types) else c for c in collection_id]
         self.dict['collectionId'] = collection_id
 
     def by_offer_id(self, offer_id):
-        if isinstance(offer_id, dict):
+        if isinstance(offer_id, records.mapping_types):
             offer_id = offer_id['offerId']
         self.dict['offerId'] = offer_id
 
     def by_recording_id(self, recording_id):
-        if isinstance(recording_id, dict):
+        if isinstance(recording_id, records.mapping_types):
             recording_id = recording_id['recordingId']
+        elif isinstance(recording_id, (list, tuple)):
+            recording_id = [r['recordingId'] if isinstance(r, records.mapping_types) else r for r in recording_id]
         self.dict['recordingId'] = recording_id
 
     def by_recording_folder_item_id(self, recording_folder_item_id):
-        if isinstance(recording_folder_item_id, dict):
+        if isinstance(recording_folder_item_id, records.mapping_types):
             recording_folder_item_id = recording_folder_item_id['recordingFolderItemId']
+        elif isinstance(recording_folder_item_id, (list, tuple)):
+            recording_folder_item_id = [r['recordingFolderItemId'] if isinstance(r, records.mapping_types) else r
+                                        for r in recording_folder_item_id]
         self.dict['recordingFolderItemId'] = recording_folder_item_id
 
     def by_station_id(self, station_id):
@@ -139,6 +153,8 @@ class SearchFilter(object):
             self.dict['levelOfDetail'] = level_of_detail
 
     def set_response_template(self, template_list=None):
+        if isinstance(template_list, Projection):
+            template_list = template_list.template()
         if template_list is None:
             try:
                 del self.dict['responseTemplate']
@@ -150,6 +166,10 @@ class SearchFilter(object):
         else:
             self.dict['responseTemplate'] = template_list[:]
 
+    def set_projection(self, projection=None):
+        """Ask for only the fields named by a Projection; the same as set_response_template(projection.template())."""
+        self.set_response_template(projection)
+
     def pop(self, key, *args):
         return self.dict.pop(key, *args)
 
@@ -160,28 +180,185 @@ class SearchFilter(object):
         return copy.copy(self.dict)
 
 
+class Projection(object):
+    """Names the fields wanted for each result type and builds the matching responseTemplate.
+
+        Projection(offer=['offerId', 'title', 'startTime', 'channel'], channel=['stationId'])
+
+    Nested objects need their own entry (here 'channel') or they come back empty.  For the result
+    types of the search methods the enclosing list type (e.g. offerList) is added automatically,
+    with isBottom so fetch_all paging still works."""
+
+    list_types = {'category': 'categoryList',
+                  'channel': 'channelList',
+                  'collection': 'collectionList',
+                  'content': 'contentList',
+                  'offer': 'offerList',
+                  'recording': 'recordingList',
+                  'recordingFolderItem': 'recordingFolderItemList',
+                  'whatsOn': 'whatsOnList'}
+
+    def __init__(self, **fields):
+        self.types = collections.OrderedDict()
+        for type_name, field_names in fields.items():
+            self.fields(type_name, *field_names)
+
+    def fields(self, type_name, *field_names):
+        """Add field_names to the fields returned for type_name; returns the Projection."""
+        if not field_names:
+            raise ValueError('No fields given for {}.'.format(type_name))
+        for name in field_names:
+            if not isinstance(name, str) or not name:
+                raise ValueError('Field names must be non-empty strings, not {!r}.'.format(name))
+        names = self.types.setdefault(type_name, [])
+        names.extend(n for n in field_names if n not in names)
+        return self
+
+    def template(self):
+        template = []
+        for type_name, names in self.types.items():
+            list_type = self.list_types.get(type_name)
+            if list_type is not None and list_type not in self.types:
+                template.append({'type': 'responseTemplate', 'typeName': list_type,
+                                 'fieldName': [type_name, 'isBottom']})
+            template.append({'type': 'responseTemplate', 'typeName': type_name, 'fieldName': list(names)})
+        return template
+
+
 class Mind(object):
 
-    def __init__(self, session, level_of_detail="medium"):
+    def __init__(self, session, level_of_detail="medium", page_window=1, cache=None, page_sizer=None,
+                 compact=False, coalescer=None, retry=None):
+        """session is a connected rpc.MRPCSession (or MultiplexedMRPCSession).  level_of_detail is
+        sent with searches whose filter sets neither levelOfDetail nor a responseTemplate.
+
+        page_window is the number of page requests kept in flight by fetch_all searches and the
+        iter_* generators.  A page_sizer (paging.AdaptivePageSizer) tunes the count of each page
+        from the timing and size of the ones before it, and with a retry (paging.RetryPolicy) a
+        fetch_all search that loses its connection reconnects the session and resumes from the
+        last page it received.
+
+        A cache (cache.ResponseCache) keeps search results for reuse, and a coalescer
+        (coalesce.RequestCoalescer), usually shared by several Minds, merges identical concurrent
+        searches.  With compact=True search results are returned as records.Record objects, which
+        hold far less memory than plain dicts for large result sets but cost several times the CPU
+        of parsing each page (see libtivomind.records)."""
         self.session = session
         self.level_of_detail = level_of_detail
+        self.page_window = page_window
+        self.cache = cache
+        self.page_sizer = page_sizer
+        self.compact = compact
+        self.coalescer = coalescer
+        self.retry = retry
+
+    def _page(self, response, target_array):
+        page = response.get(target_array, [])
+        if self.compact:
+            return records.to_records(target_array, page)
+        return page
 
     def _get_paged_response(self, req_type, payload, target_array, count=20, offset=0, fetch_all=False):
-        results = []
+        if fetch_all and self.retry is not None:
+            return self._get_resumable_response(req_type, payload, target_array, count=count, offset=offset)
+        if fetch_all:
+            return self._get_pipelined_response(req_type, payload, target_array, count=count, offset=offset,
+                                                window=self.page_window)
         payload['count'] = count
         payload['offset'] = offset
         req_id = self.session.send_request(req_type, payload)
         h, b = self.session.get_response(req_id)
-        while target_array in b and len(b[target_array]) > 0:
-            results.extend(b[target_array])
-            if 'isBottom' not in b or b['isBottom'] or not fetch_all:
-                break
-            payload['offset'] = len(results)
-            req_id = self.session.send_request(req_type, payload)
-            h, b = self.session.get_response(req_id)
-        return results
+        return self._page(b, target_array)
+
+    def _page_sizer_key(self, req_type):
+        return req_type, self.session.address, self.session.body_id
+
+    def _page_window(self, req_type, payload, count, offset, window):
+        key = None if self.page_sizer is None else self._page_sizer_key(req_type)
+        return paging.PageWindow(payload, self.session.cancel, count=count, offset=offset, window=window,
+                                 sizer=self.page_sizer, key=key)
+
+    def _get_pipelined_response(self, req_type, payload, target_array, count=20, offset=0, window=4, results=None):
+        """Fetch every page keeping up to window offset requests in flight on the session, as set out
+        in paging.PageWindow; with a page_sizer, count is only the starting size for a request type
+        and device the sizer has not seen before.  Results are appended to results, if given, which
+        then already holds the results from offset onward."""
+        results = [] if results is None else results
+        pages = self._page_window(req_type, payload, count, offset + len(results), window)
+        try:
+            while True:
+                while pages.wants():
+                    pages.sent(self.session.send_request(req_type, pages.request()))
+                h, b = self.session.get_response(pages.next_id())
+                page = self._page(b, target_array)
+                results.extend(page)
+                if pages.received(h, b, page):
+                    return results
+        finally:
+            pages.close()
+
+    def _reconnect(self):
+        try:
+            self.session.close()
+        except (OSError, rpc.MRPCError):
+            pass
+        self.session.connect()
+
+    def _get_resumable_response(self, req_type, payload, target_array, count=20, offset=0):
+        """Fetch every page as _get_pipelined_response does, but when the connection fails reconnect
+        with the session's credentials, backing off as set by retry, and continue from the first
+        page not yet received."""
+        results = []
+        attempt = 0
+        while True:
+            received = len(results)
+            try:
+                return self._get_pipelined_response(req_type, payload, target_array, count=count, offset=offset,
+                                                    window=self.page_window, results=results)
+            except (OSError, rpc.MRPCError) as e:
+                error = e
+            if len(results) > received:
+                attempt = 0
+            while True:
+                attempt += 1
+                if attempt > self.retry.max_retries:
+                    raise error
+                time.sleep(self.retry.delay(attempt))
+                self.retry.retried()
+                try:
+                    self._reconnect()
+                    break
+                except (OSError, rpc.MRPCError) as e:
+                    error = e
+            if results:
+                self.retry.resumed()
+            if 'bodyId' in payload:
+                payload['bodyId'] = self.session.body_id
+
+    def _iter_paged_response(self, req_type, payload, target_array, count=20, offset=0):
+        """Yield results page by page, keeping max(page_window, 1) further pages requested while the
+        caller consumes the current one, sized by page_sizer if there is one.  Closing the generator
+        early cancels the prefetched requests."""
+        pages = self._page_window(req_type, payload, count, offset, self.page_window)
+        try:
+            while True:
+                while pages.wants():
+                    pages.sent(self.session.send_request(req_type, pages.request()))
+                h, b = self.session.get_response(pages.next_id())
+                page = self._page(b, target_array)
+                last = pages.received(h, b, page)
+                # Top the window back up before handing over the page, so the next one is already
+                # in flight while the caller works through this one.
+                while pages.wants():
+                    pages.sent(self.session.send_request(req_type, pages.request()))
+                yield from page
+                if last:
+                    return
+        finally:
+            pages.close()
 
-    def _prepare_search(self, search_type, result_type, filt=None, options=None, count=20, offset=0, fetch_all=False):
+    def _prepare_search(self, search_type, result_type, filt=None, options=None, count=20, offset=0, fetch_all=False,
+                        stream=False):
         payload = filt if filt is not None else {}
         updates = options if options is not None and isinstance(options, dict) else {}
         if isinstance(payload, SearchFilter):
@@ -189,12 +366,41 @@ class Mind(object):
         if not (payload.keys() | options.keys()) & {'levelOfDetail', 'responseTemplate'}:
             updates['levelOfDetail'] = self.level_of_detail
         payload.update(updates)
-        return self._get_paged_response(req_type=search_type,
-                                        payload=payload,
-                                        target_array=result_type,
-                                        count=count,
-                                        offset=offset,
-                                        fetch_all=fetch_all)
+        if stream:
+            return self._iter_paged_response(search_type, payload, result_type, count=count, offset=offset)
+        return self._search(search_type, result_type, payload, count=count, offset=offset, fetch_all=fetch_all)
+
+    def _cache_key(self, search_type, payload, count, offset, fetch_all):
+        if self.cache is None or self.cache.ttl(search_type) <= 0:
+            return None
+        payload['count'] = count
+        payload['offset'] = offset
+        return self.cache.key(search_type, payload, fetch_all)
+
+    def _search(self, search_type, result_type, payload, count=20, offset=0, fetch_all=False):
+        key = self._cache_key(search_type, payload, count, offset, fetch_all)
+        if key is not None:
+            results = self.cache.get(key)
+            if results is not None:
+                return results
+
+        def fetch():
+            return self._get_paged_response(req_type=search_type,
+                                            payload=payload,
+                                            target_array=result_type,
+                                            count=count,
+                                            offset=offset,
+                                            fetch_all=fetch_all)
+
+        if self.coalescer is not None and self.coalescer.coalesces(search_type):
+            payload['count'] = count
+            payload['offset'] = offset
+            results = self.coalescer.run(self.coalescer.key(self.session, search_type, payload, fetch_all), fetch)
+        else:
+            results = fetch()
+        if key is not None:
+            self.cache.put(key, results)
+        return results
 
     def channel_search(self, filt=None, count=20, offset=0, fetch_all=False, no_limit=False):
         return self._prepare_search(search_type='channelSearch',
@@ -272,61 +478,272 @@ class Mind(object):
                                     filt=None,
                                     options={'bodyId': self.session.body_id})
 
+    def iter_channels(self, filt=None, count=20, offset=0, no_limit=False):
+        return self._prepare_search(search_type='channelSearch',
+                                    result_type='channel',
+                                    filt=filt,
+                                    options={'bodyId': self.session.body_id, 'flatten': True, 'noLimit': no_limit},
+                                    count=count,
+                                    offset=offset,
+                                    stream=True)
+
+    def iter_recording_folder_items(self, filt=None, count=20, offset=0):
+        return self._prepare_search(search_type="recordingFolderItemSearch",
+                                    result_type="recordingFolderItem",
+                                    filt=filt,
+                                    options={'bodyId': self.session.body_id, 'flatten': True},
+                                    count=count,
+                                    offset=offset,
+                                    stream=True)
+
+    def iter_recordings(self, filt=None, count=20, offset=0):
+        return self._prepare_search(search_type="recordingSearch",
+                                    result_type="recording",
+                                    filt=filt,
+                                    options={'bodyId': self.session.body_id, 'state': ['inProgress', 'scheduled']},
+                                    count=count,
+                                    offset=offset,
+                                    stream=True)
+
+    def iter_offers(self, filt=None, count=20, offset=0):
+        return self._prepare_search(search_type="offerSearch",
+                                    result_type="offer",
+                                    filt=filt,
+                                    options={'bodyId': self.session.body_id},
+                                    count=count,
+                                    offset=offset,
+                                    stream=True)
+
+    def iter_content(self, filt=None, count=20, offset=0):
+        return self._prepare_search(search_type="contentSearch",
+                                    result_type="content",
+                                    filt=filt,
+                                    options={'bodyId': self.session.body_id},
+                                    count=count,
+                                    offset=offset,
+                                    stream=True)
+
+    def iter_collections(self, filt=None, count=20, offset=0):
+        return self._prepare_search(search_type="collectionSearch",
+                                    result_type="collection",
+                                    filt=filt,
+                                    options={'bodyId': self.session.body_id, 'omitPgdImages': True},
+                                    count=count,
+                                    offset=offset,
+                                    stream=True)
+
+    def iter_categories(self, filt=None, count=20, offset=0, top_level_only=False):
+        return self._prepare_search(search_type="categorySearch",
+                                    result_type="category",
+                                    filt=filt,
+                                    options={'bodyId': self.session.body_id,
+                                             'topLevelOnly': top_level_only},
+                                    count=count,
+                                    offset=offset,
+                                    stream=True)
+
+    @staticmethod
+    def _unique_ids(items, id_field):
+        return list(dict.fromkeys(item[id_field] if isinstance(item, records.mapping_types) else item
+                                  for item in items
+                                  if not isinstance(item, records.mapping_types) or id_field in item))
+
+    def _lookup_batches(self, search_type, id_field, ids, options, batch_size):
+        for i in range(0, len(ids), batch_size):
+            batch = ids[i:i + batch_size]
+            payload = {id_field: batch if len(batch) > 1 else batch[0],
+                       'count': len(batch),
+                       'offset': 0,
+                       'levelOfDetail': self.level_of_detail}
+            payload.update(options)
+            yield payload
+
+    def _lookup(self, search_type, result_type, id_field, ids, options, batch_size=50, window=8):
+        """Return {id: result} for ids, asking for batch_size ids per request with up to window requests in flight."""
+        found = {}
+        pending = collections.deque()
+        for payload in self._lookup_batches(search_type, id_field, ids, options, batch_size):
+            pending.append(self.session.send_request(search_type, payload))
+            if len(pending) >= window:
+                h, b = self.session.get_response(pending.popleft())
+                found.update((r[id_field], r) for r in b.get(result_type, []) if id_field in r)
+        while pending:
+            h, b = self.session.get_response(pending.popleft())
+            found.update((r[id_field], r) for r in b.get(result_type, []) if id_field in r)
+        return found
+
+    def collection_lookup(self, ids, batch_size=50, window=8):
+        """Fetch the collections for a list of collectionIds (or items carrying one), deduplicated and
+        batched, returning {collectionId: collection}.  Use batch_size=1 for one pipelined request per id."""
+        return self._lookup('collectionSearch', 'collection', 'collectionId',
+                            self._unique_ids(ids, 'collectionId'),
+                            {'bodyId': self.session.body_id, 'omitPgdImages': True},
+                            batch_size=batch_size, window=window)
+
+    def content_lookup(self, ids, batch_size=50, window=8):
+        """As collection_lookup, for contentIds, returning {contentId: content}."""
+        return self._lookup('contentSearch', 'content', 'contentId',
+                            self._unique_ids(ids, 'contentId'),
+                            {'bodyId': self.session.body_id},
+                            batch_size=batch_size, window=window)
+
+    def recording_lookup(self, ids, batch_size=50, window=8):
+        """As collection_lookup, for recordingIds, returning {recordingId: recording}."""
+        return self._lookup('recordingSearch', 'recording', 'recordingId',
+                            self._unique_ids(ids, 'recordingId'),
+                            {'bodyId': self.session.body_id},
+                            batch_size=batch_size, window=window)
+
+    def recording_folder_item_lookup(self, ids, batch_size=50, window=8):
+        """As collection_lookup, for recordingFolderItemIds, returning {recordingFolderItemId: item}."""
+        return self._lookup('recordingFolderItemSearch', 'recordingFolderItem', 'recordingFolderItemId',
+                            self._unique_ids(ids, 'recordingFolderItemId'),
+                            {'bodyId': self.session.body_id, 'flatten': True},
+                            batch_size=batch_size, window=window)
+
+    @staticmethod
+    def _attach(items, id_field, key, found):
+        attached = []
+        for item in items:
+            if item.get(id_field) in found:
+                item = item.copy()
+                item[key] = found[item[id_field]]
+            attached.append(item)
+        return attached
+
+    def enrich(self, items, collections=True, content=False, batch_size=50, window=8):
+        """Return a list of items with the collection (as item['collection']) and/or content (as
+        item['content']) of each offer or recording attached, fetching each distinct id once.
+
+        Results are attached to shallow copies: the given items may be shared with a ResponseCache
+        or a RequestCoalescer and are left unchanged."""
+        if collections:
+            found = self.collection_lookup(items, batch_size=batch_size, window=window)
+            items = self._attach(items, 'collectionId', 'collection', found)
+        if content:
+            found = self.content_lookup(items, batch_size=batch_size, window=window)
+            items = self._attach(items, 'contentId', 'content', found)
+        return items
+
+    def _projection_payloads(self, projection, filt, count):
+        payload = filt.get_payload() if isinstance(filt, SearchFilter) else dict(filt or {})
+        payload.pop('levelOfDetail', None)
+        payload.pop('responseTemplate', None)
+        payload.update({'count': count, 'offset': 0})
+        full = dict(payload, levelOfDetail=self.level_of_detail)
+        projected = dict(payload, responseTemplate=projection.template())
+        return full, projected
+
+    @staticmethod
+    def _projection_savings(full_bytes, projected_bytes):
+        return {'full_bytes': full_bytes,
+                'projected_bytes': projected_bytes,
+                'saved_bytes': full_bytes - projected_bytes,
+                'saved_ratio': (full_bytes - projected_bytes) / full_bytes if full_bytes else 0.0}
+
+    def projection_savings(self, search_type, projection, filt=None, count=20):
+        """Fetch the first page of search_type (e.g. 'offerSearch') both at this Mind's level_of_detail
+        and with projection, and return the response body sizes and the bytes the projection saves."""
+        sizes = []
+        for payload in self._projection_payloads(projection, filt, count):
+            h, b = self.session.get_response(self.session.send_request(search_type, payload))
+            sizes.append(h.b_size)
+        return self._projection_savings(*sizes)
+
+    def subscribe(self, req_type, payload, callback=None):
+        """Register a multi-response request and return its subscription (see rpc.MRPCSubscription).
+
+        The session must be multiplexed (or asyncio, where this is a coroutine); the subscription
+        shares the connection with ordinary requests."""
+        return self.session.subscribe(req_type, payload, callback=callback)
+
+    def tuner_state_events(self, callback=None):
+        """Subscribe to tuner state changes, delivered as tunerStateEventRegister responses."""
+        return self.subscribe('tunerStateEventRegister', {'bodyId': self.session.body_id}, callback=callback)
+
+    def _request(self, req_type, payload):
+        req_id = self.session.send_request(req_type, payload)
+        h, b = self.session.get_response(req_id)
+        return b
+
     def send_key(self, key_event, value=None):
-        req_id = None
         if value is None:
             if isinstance(key_event, RemoteKey):
                 key_event = key_event.value
-            req_id = self.session.send_request('keyEventSend', {'event': key_event})
+            return self._request('keyEventSend', {'event': key_event})
         elif value is not None and key_event == 'ascii':
-            req_id = self.session.send_request('keyEventSend', {'event': 'ascii', 'value': value})
-        h, b = self.session.get_response(req_id)
-        return b
+            return self._request('keyEventSend', {'event': 'ascii', 'value': value})
 
     def change_channel(self, channel_id):
-        req_id = self.session.send_request('channelChange', {'channelId': channel_id})
-        h, b = self.session.get_response(req_id)
-        return b
+        return self._request('channelChange', {'channelId': channel_id})
 
     def playback(self, recording_id, hide_banner=True):
         """Initiate playback on the connected device.
 
         Note that the required id is the childRecordingId of a recording folder item."""
-        req_id = self.session.send_request('uiNavigate', {'uri': 'x-tivo:classicui:playback',
-                                                          'parameters': {'fUseTrioId': True,
-                                                                         'recordingId': recording_id,
-                                                                         'fHideBannerOnEnter': hide_banner}
-                                                          })
-        h, b = self.session.get_response(req_id)
-        return b
+        return self._request('uiNavigate', {'uri': 'x-tivo:classicui:playback',
+                                            'parameters': {'fUseTrioId': True,
+                                                           'recordingId': recording_id,
+                                                           'fHideBannerOnEnter': hide_banner}
+                                            })
 
     @staticmethod
-    def new_session(cert_path, cert_password, address, credential, port=1413, debug=False):
+    def new_session(cert_path, cert_password, address, credential, port=1413, debug=False, multiplexed=False):
         mrpc = rpc.MRPCSession.new_session(cert_path=cert_path,
                                            cert_password=cert_password,
                                            address=address,
                                            credential=credential,
                                            port=port,
-                                           debug=debug)
+                                           debug=debug,
+                                           multiplexed=multiplexed)
         mrpc.connect()
         return Mind(session=mrpc)
 
     @staticmethod
-    def new_local_session(cert_path, cert_password, address, mak, port=1413, debug=False):
+    def new_local_session(cert_path, cert_password, address, mak, port=1413, debug=False, multiplexed=False):
         mrpc = rpc.MRPCSession.new_local_session(cert_path=cert_path,
                                                  cert_password=cert_password,
                                                  address=address,
                                                  mak=mak,
                                                  port=port,
-                                                 debug=debug)
+                                                 debug=debug,
+                                                 multiplexed=multiplexed)
         mrpc.connect()
         return Mind(session=mrpc)
 
 
+class _PooledMind(object):
+
+    __slots__ = ('mind', 'borrowers', 'last_used')
+
+    def __init__(self, mind):
+        self.mind = mind
+        self.borrowers = 0
+        self.last_used = time.monotonic()
+
+
 class MindManager(object):
+    """Maintains a bounded pool of authenticated Minds handed out through the mind() context manager.
+
+    Sessions are created on demand up to max_size.  Idle sessions are closed by a single reaper
+    thread once unused for timeout seconds, although min_size sessions are always kept (and
+    re-established) once the pool has been used.  An idle session is checked for liveness before it
+    is handed out.  When every session is busy, mind() blocks for up to checkout_timeout seconds
+    (None waits forever) and then raises MRPCTimeout.
+
+    With multiplexed=True each pooled Mind runs over a MultiplexedMRPCSession and is shared:
+    callers get the least busy session, and a new one is opened only while all are in use and the
+    pool is below max_size.
+
+    With coalesce=True identical searches made concurrently through any of the pooled Minds share
+    one RPC (see coalesce.RequestCoalescer); pass a RequestCoalescer instead to choose which
+    request types may be coalesced."""
 
     def __init__(self, cert_path, cert_password, address, credential,
-                 port=1413, debug=False, timeout=120):
+                 port=1413, debug=False, timeout=120, multiplexed=False,
+                 min_size=0, max_size=1, checkout_timeout=None, coalesce=False):
+        if max_size < 1 or min_size < 0 or min_size > max_size:
+            raise ValueError("Pool sizes must satisfy 0 <= min_size <= max_size and max_size >= 1.")
         self.__cert_path = cert_path
         self.__cert_password = cert_password
         self.__address = address
@@ -334,36 +751,140 @@ class MindManager(object):
         self.__port = port
         self.__debug = debug
         self.__timeout = timeout
-        self.__mind = None
-        self.__timer = None
-        pass
+        self.__multiplexed = multiplexed
+        self.__min_size = min_size
+        self.__max_size = max_size
+        self.__checkout_timeout = checkout_timeout
+        if isinstance(coalesce, coalescing.RequestCoalescer):
+            self.coalescer = coalesce
+        else:
+            self.coalescer = coalescing.RequestCoalescer() if coalesce else None
+        self.__entries = []
+        self.__creating = 0
+        self.__cond = threading.Condition()
+        self.__reaper = None
+        self.__stop = threading.Event()
+
+    @property
+    def size(self):
+        with self.__cond:
+            return len(self.__entries)
+
+    def __new_mind(self):
+        mind = Mind.new_session(cert_path=self.__cert_path,
+                                cert_password=self.__cert_password,
+                                address=self.__address,
+                                credential=self.__credential,
+                                port=self.__port,
+                                debug=self.__debug,
+                                multiplexed=self.__multiplexed)
+        mind.coalescer = self.coalescer
+        return mind
 
-    def disconnect(self):
+    @staticmethod
+    def __close(entry):
         try:
-            self.__mind.session.close()
-        except AttributeError:
+            entry.mind.session.close()
+        except (OSError, rpc.MRPCError):
             pass
-        finally:
-            self.__mind = None
-        if threading.current_thread().getName() == threading.main_thread().getName():
+
+    def __start_reaper(self):
+        if self.__reaper is None:
+            self.__stop.clear()
+            self.__reaper = threading.Thread(target=self.__reap_loop, name="MindManagerReaper", daemon=True)
+            self.__reaper.start()
+
+    def __reap_loop(self):
+        while not self.__stop.wait(max(self.__timeout / 2, 0.05)):
+            self.reap()
+
+    def reap(self):
+        """Close sessions idle for longer than timeout, then top the pool back up to min_size."""
+        now = time.monotonic()
+        with self.__cond:
+            idle = sorted((e for e in self.__entries if e.borrowers == 0), key=lambda e: e.last_used)
+            evictable = len(self.__entries) - self.__min_size
+            stale = [e for e in idle if now - e.last_used > self.__timeout][:max(evictable, 0)]
+            for entry in stale:
+                self.__entries.remove(entry)
+            missing = self.__min_size - len(self.__entries) - self.__creating
+            self.__creating += max(missing, 0)
+        for entry in stale:
+            self.__close(entry)
+        for _ in range(missing):
             try:
-                self.__timer.cancel()
-            except AttributeError:
-                pass
-            finally:
-                self.__timer = None
+                entry = _PooledMind(self.__new_mind())
+            except (OSError, rpc.MRPCError):
+                entry = None
+            with self.__cond:
+                self.__creating -= 1
+                if entry is not None:
+                    self.__entries.append(entry)
+                self.__cond.notify()
+
+    def __checkout(self):
+        deadline = None if self.__checkout_timeout is None else time.monotonic() + self.__checkout_timeout
+        while True:
+            with self.__cond:
+                self.__start_reaper()
+                entry = None
+                while entry is None:
+                    candidates = [e for e in self.__entries if self.__multiplexed or e.borrowers == 0]
+                    if candidates:
+                        entry = min(candidates, key=lambda e: (e.borrowers, -e.last_used))
+                        if entry.borrowers > 0 and len(self.__entries) + self.__creating < self.__max_size:
+                            entry = None
+                    if entry is None and len(self.__entries) + self.__creating < self.__max_size:
+                        self.__creating += 1
+                        break
+                    if entry is None:
+                        remaining = None if deadline is None else deadline - time.monotonic()
+                        if remaining is not None and remaining <= 0:
+                            raise rpc.MRPCTimeout("No Mind available within {} seconds.".format(
+                                self.__checkout_timeout))
+                        self.__cond.wait(remaining)
+                if entry is not None:
+                    check = entry.borrowers == 0
+                    entry.borrowers += 1
+            if entry is None:
+                try:
+                    entry = _PooledMind(self.__new_mind())
+                    entry.borrowers = 1
+                finally:
+                    with self.__cond:
+                        self.__creating -= 1
+                        if entry is not None:
+                            self.__entries.append(entry)
+                        self.__cond.notify()
+                return entry
+            if not check or entry.mind.session.is_alive():
+                return entry
+            with self.__cond:
+                self.__entries.remove(entry)
+                self.__cond.notify()
+            self.__close(entry)
+
+    def __checkin(self, entry):
+        with self.__cond:
+            entry.borrowers -= 1
+            entry.last_used = time.monotonic()
+            self.__cond.notify()
+
+    def disconnect(self):
+        """Close every pooled session and stop the reaper."""
+        with self.__cond:
+            entries, self.__entries = self.__entries, []
+            reaper, self.__reaper = self.__reaper, None
+            self.__stop.set()
+        for entry in entries:
+            self.__close(entry)
+        if reaper is not None and reaper is not threading.current_thread():
+            reaper.join()
 
     @contextlib.contextmanager
     def mind(self):
-        if self.__timer is not None:
-            self.__timer.cancel()
-            self.__timer = None
-        if self.__mind is None:
-            self.__mind = Mind.new_session(cert_path=self.__cert_path,
-                                           cert_password=self.__cert_password,
-                                           address=self.__address,
-                                           credential=self.__credential,
-                                           port=self.__port,
-                                           debug=self.__debug)
-        yield self.__mind
-        self.__timer = threading.Timer(self.__timeout, self.disconnect)
+        entry = self.__checkout()
+        try:
+            yield entry.mind
+        finally:
+            self.__checkin(entry)
@@ -0,0 +1,109 @@
+import collections
+import json
+import threading
+import time
+
+
+class ResponseCache(object):
+    """A thread-safe TTL/LRU cache of search results.
+
+    Entries are keyed by the request type and a canonical form of the final request payload
+    (including count, offset, levelOfDetail and responseTemplate) plus the fetch_all flag.  Each
+    request type has its own time to live in seconds; a TTL of 0 disables caching for that type.
+    The cache is bounded by entry count and, optionally, by the approximate serialized size of the
+    cached results, evicting least recently used entries first.  Sizes are only measured, at the
+    cost of serializing each result set once on put, when max_bytes is set; otherwise the bytes
+    stat stays 0.
+
+    Cached result lists are returned as new lists, but the result dicts themselves are shared
+    between callers and must not be modified."""
+
+    DEFAULT_TTLS = {"categorySearch": 86400,
+                    "channelSearch": 3600,
+                    "collectionSearch": 3600,
+                    "contentSearch": 600,
+                    "offerSearch": 60,
+                    "recordingFolderItemSearch": 30,
+                    "recordingSearch": 30,
+                    "whatsOnSearch": 10,
+                    "tunerStateEventRegister": 0}
+
+    def __init__(self, max_entries=1024, max_bytes=None, ttls=None, default_ttl=60):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttls = dict(ResponseCache.DEFAULT_TTLS)
+        if ttls is not None:
+            self.ttls.update(ttls)
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    @staticmethod
+    def key(req_type, payload, fetch_all=False):
+        return req_type, json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str), fetch_all
+
+    def ttl(self, req_type):
+        return self.ttls.get(req_type, self.default_ttl)
+
+    def get(self, key):
+        """Return a copy of the cached result list for key, or None on a miss."""
+        now = time.monotonic()
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry[0] <= now:
+                self.__discard(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return list(entry[1])
+
+    def put(self, key, results):
+        ttl = self.ttl(key[0])
+        if ttl <= 0:
+            return
+        size = 0
+        if self.max_bytes is not None:
+            size = len(key[1]) + len(json.dumps(results, separators=(',', ':'), default=self.__plain))
+            if size > self.max_bytes:
+                return
+        with self.__lock:
+            if key in self.__entries:
+                self.__discard(key)
+            self.__entries[key] = (time.monotonic() + ttl, list(results), size)
+            self.bytes += size
+            while len(self.__entries) > self.max_entries or \
+                    (self.max_bytes is not None and self.bytes > self.max_bytes):
+                self.__discard(next(iter(self.__entries)))
+                self.evictions += 1
+
+    @staticmethod
+    def __plain(value):
+        return value.to_dict() if hasattr(value, 'to_dict') else str(value)
+
+    def __discard(self, key):
+        expires, results, size = self.__entries.pop(key)
+        self.bytes -= size
+
+    def invalidate(self, req_type=None):
+        """Drop every entry, or only those for req_type."""
+        with self.__lock:
+            for key in [k for k in self.__entries if req_type is None or k[0] == req_type]:
+                self.__discard(key)
+
+    def stats(self):
+        with self.__lock:
+            return {"entries": len(self.__entries),
+                    "bytes": self.bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions}
@@ -0,0 +1,87 @@
+import json
+import threading
+
+
+class _Flight(object):
+
+    __slots__ = ('done', 'results', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+        self.waiters = 0
+
+
+class RequestCoalescer(object):
+    """Single-flight coalescing of identical concurrent searches.
+
+    While a search is in flight, any identical search (same device, request type, canonical payload
+    and fetch_all flag) started from another thread waits for it instead of sending its own RPC, and
+    every waiter gets the same results or the same exception.  Only the request types in
+    request_types are coalesced; commands that change the device's state can never be.
+
+    Like ResponseCache, the waiters get their own result lists but share the result dicts."""
+
+    DEFAULT_TYPES = frozenset(("categorySearch",
+                               "channelSearch",
+                               "collectionSearch",
+                               "contentSearch",
+                               "offerSearch",
+                               "recordingFolderItemSearch",
+                               "recordingSearch",
+                               "tunerStateEventRegister",
+                               "whatsOnSearch"))
+    NEVER_COALESCED = frozenset(("bodyAuthenticate", "channelChange", "keyEventSend", "uiNavigate"))
+
+    def __init__(self, request_types=DEFAULT_TYPES):
+        request_types = frozenset(request_types)
+        if request_types & RequestCoalescer.NEVER_COALESCED:
+            raise ValueError("{} cannot be coalesced.".format(
+                ", ".join(sorted(request_types & RequestCoalescer.NEVER_COALESCED))))
+        self.request_types = request_types
+        self.flights = 0
+        self.coalesced = 0
+        self.__in_flight = {}
+        self.__lock = threading.Lock()
+
+    def coalesces(self, req_type):
+        return req_type in self.request_types
+
+    @staticmethod
+    def key(session, req_type, payload, fetch_all=False):
+        return (session.address, session.port, session.body_id, req_type,
+                json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str), fetch_all)
+
+    def run(self, key, fetch):
+        """Return fetch()'s results, sharing them with every identical call made while it runs."""
+        with self.__lock:
+            flight = self.__in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.__in_flight[key] = _Flight()
+                self.flights += 1
+            else:
+                flight.waiters += 1
+                self.coalesced += 1
+        if leader:
+            try:
+                flight.results = fetch()
+            except Exception as e:
+                flight.error = e
+                raise
+            finally:
+                with self.__lock:
+                    del self.__in_flight[key]
+                flight.done.set()
+            return flight.results
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return list(flight.results)
+
+    def stats(self):
+        with self.__lock:
+            return {"in_flight": len(self.__in_flight),
+                    "flights": self.flights,
+                    "coalesced": self.coalesced}
@@ -0,0 +1,188 @@
+import concurrent.futures
+import threading
+import time
+
+import libtivomind.api as api
+import libtivomind.rpc as rpc
+
+
+class FleetResult(object):
+    """The outcome of running a call against one device: value on success, error otherwise."""
+
+    __slots__ = ('device', 'value', 'error', 'elapsed')
+
+    def __init__(self, device, value=None, error=None, elapsed=0.0):
+        self.device = device
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return "FleetResult({!r}, {})".format(self.device, "ok" if self.ok else repr(self.error))
+
+
+class _Device(object):
+
+    __slots__ = ('name', 'address', 'mak', 'mind', 'lock')
+
+    def __init__(self, name, address, mak):
+        self.name = name
+        self.address = address
+        self.mak = mak
+        self.mind = None
+        self.lock = threading.Lock()
+
+
+class Fleet(object):
+    """Runs Mind calls against many TiVo devices concurrently.
+
+    devices maps a name to an address, or to an (address, mak) tuple for devices that do not use
+    the fleet-wide mak.  A Mind is opened for each device the first time it is used and kept for
+    later calls; a device whose call fails is reconnected on its next use.
+
+    run() streams a FleetResult per device as each finishes.  A device that has not answered within
+    timeout seconds of its call starting is reported with an MRPCTimeout error and its session is
+    closed, so one unresponsive unit never holds up the rest."""
+
+    def __init__(self, cert_path, cert_password, devices, mak=None, port=1413, timeout=30, max_workers=None,
+                 debug=False, multiplexed=False):
+        self.__cert_path = cert_path
+        self.__cert_password = cert_password
+        self.__port = port
+        self.__debug = debug
+        self.__multiplexed = multiplexed
+        self.timeout = timeout
+        self.devices = {}
+        for name, spec in devices.items():
+            address, device_mak = spec if isinstance(spec, tuple) else (spec, mak)
+            if device_mak is None:
+                raise ValueError("No MAK for device {}.".format(name))
+            self.devices[name] = _Device(name, address, device_mak)
+        self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or max(len(self.devices), 1),
+                                                                thread_name_prefix="Fleet")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Close every device session and stop the worker threads."""
+        self.__executor.shutdown(wait=False)
+        for device in self.devices.values():
+            self.__disconnect(device)
+
+    @staticmethod
+    def __disconnect(device):
+        mind, device.mind = device.mind, None
+        if mind is not None:
+            try:
+                mind.session.close()
+            except (OSError, rpc.MRPCError):
+                pass
+
+    def mind(self, name):
+        """Return the connected Mind for a device, connecting it if needed."""
+        device = self.devices[name]
+        if device.mind is None:
+            device.mind = api.Mind.new_local_session(cert_path=self.__cert_path,
+                                                     cert_password=self.__cert_password,
+                                                     address=device.address,
+                                                     mak=device.mak,
+                                                     port=self.__port,
+                                                     debug=self.__debug,
+                                                     multiplexed=self.__multiplexed)
+        return device.mind
+
+    def __call(self, device, func, started):
+        with device.lock:
+            started[device.name] = time.monotonic()
+            try:
+                value = func(self.mind(device.name))
+            except BaseException:
+                self.__disconnect(device)
+                raise
+            return value, time.monotonic() - started[device.name]
+
+    def run(self, func, devices=None, timeout=-1):
+        """Call func(mind) for each named device (default: all) concurrently, yielding a FleetResult
+        for each as it completes.  timeout defaults to the fleet timeout; None waits forever."""
+        timeout = self.timeout if timeout == -1 else timeout
+        started = {}
+        pending = {}
+        for name in (self.devices if devices is None else devices):
+            device = self.devices[name]
+            pending[self.__executor.submit(self.__call, device, func, started)] = device
+        while pending:
+            wait = None
+            if timeout is not None:
+                now = time.monotonic()
+                starts = [started[d.name] for d in pending.values() if d.name in started]
+                wait = max(min(starts) + timeout - now, 0) if starts else timeout
+            done, not_done = concurrent.futures.wait(pending, timeout=wait,
+                                                     return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                device = pending.pop(future)
+                try:
+                    value, elapsed = future.result()
+                    yield FleetResult(device.name, value=value, elapsed=elapsed)
+                except Exception as e:
+                    yield FleetResult(device.name, error=e, elapsed=time.monotonic() - started.get(device.name, 0))
+            if timeout is None:
+                continue
+            now = time.monotonic()
+            for future, device in list(pending.items()):
+                if device.name in started and now - started[device.name] >= timeout:
+                    del pending[future]
+                    self.__disconnect(device)
+                    yield FleetResult(device.name, elapsed=now - started[device.name],
+                                      error=rpc.MRPCTimeout("{} did not answer within {} seconds.".format(
+                                          device.name, timeout)))
+
+    def gather(self, func, devices=None, timeout=-1):
+        """As run(), but wait for every device and return {name: FleetResult}."""
+        return {r.device: r for r in self.run(func, devices=devices, timeout=timeout)}
+
+    def call(self, method, *args, devices=None, timeout=-1, **kwargs):
+        """Stream the results of calling a Mind method by name, e.g. call('tuner_state')."""
+        return self.run(lambda mind: getattr(mind, method)(*args, **kwargs), devices=devices, timeout=timeout)
+
+    @staticmethod
+    def locate(results, key):
+        """Return {key value: [device names]} over the items of successful list results, e.g. which
+        devices hold each recordingId."""
+        found = {}
+        for result in results:
+            if result.ok:
+                for item in result.value:
+                    if key in item and result.device not in found.setdefault(item[key], []):
+                        found[item[key]].append(result.device)
+        return found
+
+    @staticmethod
+    def merge(results, key=None):
+        """Concatenate the items of successful list results, keeping only the first item seen for
+        each value of key (e.g. 'contentId' or 'recordingId') when key is given."""
+        merged = []
+        seen = set()
+        for result in results:
+            if not result.ok:
+                continue
+            for item in result.value:
+                if key is not None and key in item:
+                    if item[key] in seen:
+                        continue
+                    seen.add(item[key])
+                merged.append(item)
+        return merged
+
+    def search(self, method, *args, key=None, devices=None, timeout=-1, **kwargs):
+        """Run a Mind search method on every device and return (merged items, {name: error}) for
+        the devices that failed or timed out."""
+        results = list(self.call(method, *args, devices=devices, timeout=timeout, **kwargs))
+        return self.merge(results, key=key), {r.device: r.error for r in results if not r.ok}
@@ -0,0 +1,302 @@
+import concurrent.futures
+import datetime
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+import libtivomind.api as api
+import libtivomind.rpc as rpc
+
+
+class GuideIndex(object):
+    """A local SQLite copy of the program guide, refreshed incrementally from a Mind.
+
+    Channels and offers are bulk-loaded with channel_search and time-windowed offer_search calls.
+    The guide is tracked in fixed windows of window_size seconds aligned to the epoch, and sync()
+    only fetches windows that have never been loaded or were loaded more than max_age seconds ago.
+
+    offer_search() and channel_search() accept the same SearchFilter objects as the Mind methods
+    and answer them from the local store, so they never touch the device."""
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS channel (
+            stationId TEXT PRIMARY KEY,
+            channelNumber TEXT,
+            callSign TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS offer (
+            offerId TEXT PRIMARY KEY,
+            stationId TEXT,
+            startTime TEXT,
+            endTime TEXT,
+            collectionId TEXT,
+            contentId TEXT,
+            title TEXT,
+            subtitle TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS offer_station ON offer (stationId, startTime);
+        CREATE INDEX IF NOT EXISTS offer_start ON offer (startTime);
+        CREATE INDEX IF NOT EXISTS offer_collection ON offer (collectionId);
+        CREATE INDEX IF NOT EXISTS offer_content ON offer (contentId);
+        CREATE TABLE IF NOT EXISTS window (
+            start TEXT PRIMARY KEY,
+            loaded REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS sync_state (
+            name TEXT PRIMARY KEY,
+            loaded REAL NOT NULL
+        );
+    '''
+
+    # SearchFilter keys mapped to (column, SQL operator); the keyword variants match substrings.
+    filter_columns = {'stationId': ('stationId', '='),
+                      'offerId': ('offerId', '='),
+                      'collectionId': ('collectionId', '='),
+                      'contentId': ('contentId', '='),
+                      'title': ('title', '='),
+                      'titleKeyword': ('title', 'LIKE'),
+                      'subtitle': ('subtitle', '='),
+                      'subtitleKeyword': ('subtitle', 'LIKE'),
+                      'minStartTime': ('startTime', '>='),
+                      'maxStartTime': ('startTime', '<='),
+                      'minEndTime': ('endTime', '>='),
+                      'maxEndTime': ('endTime', '<=')}
+    channel_filter_columns = {'stationId': ('stationId', '='),
+                              'channelNumber': ('channelNumber', '='),
+                              'callSign': ('callSign', '=')}
+    # Keys Mind adds to every search payload, which have no meaning locally.
+    ignored_keys = {'bodyId', 'levelOfDetail', 'responseTemplate', 'flatten', 'noLimit', 'omitPgdImages'}
+    # The only keys sync() accepts in filt: they shape each offer but do not narrow the result set.
+    sync_filter_keys = {'levelOfDetail', 'responseTemplate', 'omitPgdImages'}
+
+    def __init__(self, mind, path=':memory:', window_size=3600, page_size=50):
+        self.mind = mind
+        self.window_size = window_size
+        self.page_size = page_size
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(self.schema)
+        self.lock = threading.RLock()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    @staticmethod
+    def __json(item):
+        return json.dumps(item, default=lambda record: record.to_dict())
+
+    @staticmethod
+    def __station_id(item):
+        if 'stationId' in item:
+            return item['stationId']
+        return item.get('channel', {}).get('stationId')
+
+    @staticmethod
+    def __end_time(offer):
+        try:
+            start = datetime.datetime.strptime(offer['startTime'], "%Y-%m-%d %H:%M:%S")
+            return rpc.MRPCSession.get_date_string(start + datetime.timedelta(seconds=offer['duration']))
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def __window_start(self, utc_time):
+        epoch = datetime.datetime(1970, 1, 1)
+        seconds = int((utc_time - epoch).total_seconds())
+        return epoch + datetime.timedelta(seconds=seconds - seconds % self.window_size)
+
+    def stale_windows(self, min_utc_time, max_utc_time, max_age=3600):
+        """Return the start times of the windows overlapping [min_utc_time, max_utc_time) that need loading."""
+        cutoff = time.time() - max_age
+        with self.lock:
+            loaded = dict(self.db.execute('SELECT start, loaded FROM window'))
+        stale = []
+        start = self.__window_start(min_utc_time)
+        while start < max_utc_time:
+            if loaded.get(rpc.MRPCSession.get_date_string(start), 0) < cutoff:
+                stale.append(start)
+            start += datetime.timedelta(seconds=self.window_size)
+        return stale
+
+    def sync_channels(self, max_age=86400):
+        """Reload the channel list if it is older than max_age seconds; returns the number of channels loaded."""
+        with self.lock:
+            row = self.db.execute("SELECT loaded FROM sync_state WHERE name = 'channel'").fetchone()
+        if row is not None and row[0] >= time.time() - max_age:
+            return 0
+        channels = self.mind.channel_search(count=self.page_size, fetch_all=True)
+        rows = [(self.__station_id(c), c.get('channelNumber'), c.get('callSign'), self.__json(c))
+                for c in channels]
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM channel')
+            self.db.executemany('INSERT OR REPLACE INTO channel VALUES (?, ?, ?, ?)', rows)
+            self.db.execute("INSERT OR REPLACE INTO sync_state VALUES ('channel', ?)", (time.time(),))
+        return len(rows)
+
+    def sync(self, min_utc_time, max_utc_time, max_age=3600, filt=None):
+        """Load the offers starting in [min_utc_time, max_utc_time) for every stale window.
+
+        Runs of adjacent stale windows are fetched with a single fetch_all offer_search.  filt may set
+        levelOfDetail, responseTemplate or omitPgdImages for the device search; criteria that would
+        narrow it (such as a station) raise ValueError, since each window is replaced and marked
+        loaded as a whole.  Returns the number of offers loaded."""
+        if filt is not None:
+            narrowing = set(filt.get_payload()) - self.sync_filter_keys
+            if narrowing:
+                raise ValueError('GuideIndex.sync() loads whole windows and cannot be narrowed by {}.'.format(
+                    ', '.join(sorted(narrowing))))
+        window = datetime.timedelta(seconds=self.window_size)
+        runs = []
+        for start in self.stale_windows(min_utc_time, max_utc_time, max_age=max_age):
+            if runs and runs[-1][1] == start:
+                runs[-1][1] = start + window
+            else:
+                runs.append([start, start + window])
+        total = 0
+        for run_start, run_end in runs:
+            total += self.__load_offers(run_start, run_end, filt)
+        return total
+
+    def __load_offers(self, run_start, run_end, filt):
+        search = api.SearchFilter()
+        if filt is not None:
+            search.by_user_fields(filt.get_payload())
+        search.by_start_time(run_start, run_end - datetime.timedelta(seconds=1))
+        offers = self.mind.offer_search(filt=search, count=self.page_size, fetch_all=True)
+        rows = [(o['offerId'], self.__station_id(o), o.get('startTime'), self.__end_time(o), o.get('collectionId'),
+                 o.get('contentId'), o.get('title'), o.get('subtitle'), self.__json(o))
+                for o in offers if 'offerId' in o]
+        window = datetime.timedelta(seconds=self.window_size)
+        starts = []
+        start = run_start
+        while start < run_end:
+            starts.append((rpc.MRPCSession.get_date_string(start), time.time()))
+            start += window
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM offer WHERE startTime >= ? AND startTime < ?',
+                            (rpc.MRPCSession.get_date_string(run_start), rpc.MRPCSession.get_date_string(run_end)))
+            self.db.executemany('INSERT OR REPLACE INTO offer VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.db.executemany('INSERT OR REPLACE INTO window VALUES (?, ?)', starts)
+        return len(rows)
+
+    def expire(self, before_utc_time):
+        """Delete offers, and forget windows, that start before before_utc_time."""
+        cutoff = rpc.MRPCSession.get_date_string(before_utc_time)
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM offer WHERE startTime < ?', (cutoff,))
+            self.db.execute('DELETE FROM window WHERE start < ?', (cutoff,))
+
+    def __query(self, table, columns, filt, count, offset, default_order):
+        payload = filt.get_payload() if isinstance(filt, api.SearchFilter) else dict(filt or {})
+        order = payload.pop('orderBy', default_order)
+        clauses = []
+        params = []
+        for key, value in payload.items():
+            if key in self.ignored_keys:
+                continue
+            if key not in columns:
+                raise ValueError('{} is not supported by the local guide index.'.format(key))
+            column, op = columns[key]
+            if isinstance(value, (list, tuple)):
+                if op != '=':
+                    raise ValueError('{} does not accept a list in the local guide index.'.format(key))
+                clauses.append('{} IN ({})'.format(column, ', '.join('?' * len(value))))
+                params.extend(value)
+                continue
+            if op == 'LIKE':
+                value = '%{}%'.format(value)
+            clauses.append('{} {} ?'.format(column, op))
+            params.append(value)
+        order_columns = {c for c, op in columns.values()}
+        for field in [order] if isinstance(order, str) else order:
+            if field.lstrip('-') not in order_columns:
+                raise ValueError('Cannot order by {}.'.format(field))
+        order_sql = ', '.join('{} DESC'.format(f[1:]) if f.startswith('-') else f
+                              for f in ([order] if isinstance(order, str) else order))
+        sql = 'SELECT data FROM {}'.format(table)
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY {} LIMIT ? OFFSET ?'.format(order_sql)
+        params.extend([-1 if count is None else count, offset])
+        with self.lock:
+            return [json.loads(row[0]) for row in self.db.execute(sql, params)]
+
+    def offer_search(self, filt=None, count=None, offset=0):
+        """Return locally stored offers matching filt, ordered by startTime unless filt sets orderBy."""
+        return self.__query('offer', self.filter_columns, filt, count, offset, ['startTime', 'stationId'])
+
+    def channel_search(self, filt=None, count=None, offset=0):
+        return self.__query('channel', self.channel_filter_columns, filt, count, offset, 'channelNumber')
+
+
+class ShardedOfferFetcher(object):
+    """Fetches the offers of a long time range as many small, concurrent offer_searches.
+
+    The range is split into shards of shard_size seconds (and, if station ids are given, into
+    groups of stations_per_shard stations), and up to concurrency shards are fetched at once.  Each
+    plain Mind serves one shard at a time, while a Mind over a MultiplexedMRPCSession may serve up
+    to concurrency shards at once.  Offers returned by more than one shard are kept once, and the
+    result is ordered by startTime, stationId and offerId whatever order the shards finish in."""
+
+    def __init__(self, minds, shard_size=6 * 3600, concurrency=4, page_size=50, stations_per_shard=1):
+        self.minds = minds if isinstance(minds, (list, tuple)) else [minds]
+        self.shard_size = shard_size
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.stations_per_shard = stations_per_shard
+
+    def shards(self, min_utc_time, max_utc_time, station_ids=None):
+        """Return the (start, end, station ids or None) shards covering [min_utc_time, max_utc_time)."""
+        size = datetime.timedelta(seconds=self.shard_size)
+        windows = []
+        start = min_utc_time
+        while start < max_utc_time:
+            windows.append((start, min(start + size, max_utc_time)))
+            start += size
+        if not station_ids:
+            return [(start, end, None) for start, end in windows]
+        groups = [list(station_ids[i:i + self.stations_per_shard])
+                  for i in range(0, len(station_ids), self.stations_per_shard)]
+        return [(start, end, group) for start, end in windows for group in groups]
+
+    def __slots(self):
+        slots = queue.Queue()
+        for mind in self.minds:
+            for _ in range(self.concurrency if isinstance(mind.session, rpc.MultiplexedMRPCSession) else 1):
+                slots.put(mind)
+        return slots
+
+    def __fetch_shard(self, slots, shard, filt):
+        start, end, stations = shard
+        search = api.SearchFilter()
+        if filt is not None:
+            search.by_user_fields(filt.get_payload() if isinstance(filt, api.SearchFilter) else filt)
+        search.by_start_time(start, end - datetime.timedelta(seconds=1))
+        if stations is not None:
+            search.by_station_id(stations if len(stations) > 1 else stations[0])
+        mind = slots.get()
+        try:
+            return mind.offer_search(filt=search, count=self.page_size, fetch_all=True)
+        finally:
+            slots.put(mind)
+
+    @staticmethod
+    def __order(offer):
+        channel = offer.get('channel') or {}
+        return offer.get('startTime') or '', channel.get('stationId') or '', offer.get('offerId') or ''
+
+    def fetch(self, min_utc_time, max_utc_time, station_ids=None, filt=None):
+        """Return the offers starting in [min_utc_time, max_utc_time), optionally only on station_ids.
+        filt may carry further SearchFilter criteria for every shard."""
+        slots = self.__slots()
+        shards = self.shards(min_utc_time, max_utc_time, station_ids)
+        offers = {}
+        workers = max(min(self.concurrency, slots.qsize(), len(shards)), 1)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="GuideShard") as pool:
+            for page in pool.map(lambda shard: self.__fetch_shard(slots, shard, filt), shards):
+                for offer in page:
+                    offers.setdefault(offer.get('offerId'), offer)
+        return sorted(offers.values(), key=self.__order)
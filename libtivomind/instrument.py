@@ -0,0 +1,105 @@
+import collections
+import threading
+
+
+class MRPCObserver(object):
+    """Base class for session observers; every hook is a no-op.
+
+    Install an observer with ``session.observer = obs``.  Sessions without an observer skip all
+    timing work.  on_send, on_first_byte and on_response receive an rpc.MRPCEvent.  on_first_byte
+    is called as soon as the response's headers have arrived, with first_byte_time measured, while
+    its body may still be on the way; on_response follows once the body is in and parsed, so the
+    gap between the two shows a stalled transfer.  Hooks run on the thread (or event loop) that
+    reads the response, as it reads, and should return quickly."""
+
+    def on_send(self, event):
+        pass
+
+    def on_first_byte(self, event):
+        pass
+
+    def on_response(self, event):
+        pass
+
+    def on_out_of_order(self, rpc_id):
+        """A response arrived before the one being waited for and was queued."""
+        pass
+
+    def on_reconnect(self, session):
+        pass
+
+
+class CallbackObserver(MRPCObserver):
+    """An observer that forwards each hook to an optional callable."""
+
+    def __init__(self, on_send=None, on_first_byte=None, on_response=None, on_out_of_order=None,
+                 on_reconnect=None):
+        for name, callback in (('on_send', on_send), ('on_first_byte', on_first_byte),
+                               ('on_response', on_response), ('on_out_of_order', on_out_of_order),
+                               ('on_reconnect', on_reconnect)):
+            if callback is not None:
+                setattr(self, name, callback)
+
+
+class RequestTypeStats(object):
+
+    __slots__ = ('count', 'request_bytes', 'response_bytes', 'serialize_time', 'network_time',
+                 'max_network_time', 'parse_time')
+
+    def __init__(self):
+        self.count = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.serialize_time = 0.0
+        self.network_time = 0.0
+        self.max_network_time = 0.0
+        self.parse_time = 0.0
+
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+class MRPCStats(MRPCObserver):
+    """An observer that aggregates counters and timings per request type, ready to export to a
+    metrics system.  It may be shared by several sessions."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.responses = 0
+        self.out_of_order = 0
+        self.reconnects = 0
+        self.by_type = collections.defaultdict(RequestTypeStats)
+
+    def on_send(self, event):
+        with self.lock:
+            self.requests += 1
+
+    def on_response(self, event):
+        with self.lock:
+            self.responses += 1
+            stats = self.by_type[event.request_type]
+            stats.count += 1
+            stats.request_bytes += event.request_header_size + event.request_body_size
+            stats.response_bytes += event.response_header_size + event.response_body_size
+            stats.serialize_time += event.serialize_time
+            stats.parse_time += event.parse_time or 0.0
+            if event.network_time is not None:
+                stats.network_time += event.network_time
+                stats.max_network_time = max(stats.max_network_time, event.network_time)
+
+    def on_out_of_order(self, rpc_id):
+        with self.lock:
+            self.out_of_order += 1
+
+    def on_reconnect(self, session):
+        with self.lock:
+            self.reconnects += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {'requests': self.requests,
+                    'responses': self.responses,
+                    'out_of_order': self.out_of_order,
+                    'reconnects': self.reconnects,
+                    'by_type': {k: v.as_dict() for k, v in self.by_type.items()}}
@@ -0,0 +1,168 @@
+import json
+import sqlite3
+import threading
+import time
+
+import libtivomind.api as api
+
+
+class LibraryChange(object):
+    """One difference found by RecordingLibrary.sync().  action is 'added', 'changed' or 'removed';
+    item is the new full-detail result, or the last stored one for a removal."""
+
+    __slots__ = ('kind', 'action', 'item_id', 'item')
+
+    def __init__(self, kind, action, item_id, item):
+        self.kind = kind
+        self.action = action
+        self.item_id = item_id
+        self.item = item
+
+    def __repr__(self):
+        return "LibraryChange({!r}, {!r}, {!r})".format(self.kind, self.action, self.item_id)
+
+
+class RecordingLibrary(object):
+    """A persisted snapshot of a device's recordings that is kept up to date incrementally.
+
+    Each sync() first lists every recording folder item and recording with a responseTemplate that
+    asks only for the fields in fingerprint_fields, which is cheap to transfer.  Comparing those
+    fingerprints with the SQLite snapshot gives the added, changed and removed items; only the added
+    and changed ones are then fetched in full, in batched lookups.  Subscribers are called with a
+    LibraryChange for every difference once the snapshot has been updated."""
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS item (
+            kind TEXT NOT NULL,
+            id TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (kind, id)
+        );
+        CREATE TABLE IF NOT EXISTS sync_state (
+            name TEXT PRIMARY KEY,
+            loaded REAL NOT NULL
+        );
+    '''
+
+    # For each kind: the id field and the names of the Mind search and lookup methods.
+    kinds = {'recordingFolderItem': ('recordingFolderItemId', 'recording_folder_item_search',
+                                     'recording_folder_item_lookup'),
+             'recording': ('recordingId', 'recording_search', 'recording_lookup')}
+    # Fields whose values identify a version of an item; a change to any of them triggers a full fetch.
+    default_fingerprint_fields = {'recordingFolderItem': ('recordingFolderItemId', 'childRecordingId', 'title',
+                                                          'folderItemCount', 'startTime', 'recordingStatusType',
+                                                          'folderTransfer'),
+                                  'recording': ('recordingId', 'title', 'subtitle', 'state', 'startTime',
+                                                'duration', 'deletionPolicy')}
+
+    def __init__(self, mind, path=':memory:', page_size=50, batch_size=50, fingerprint_fields=None):
+        self.mind = mind
+        self.page_size = page_size
+        self.batch_size = batch_size
+        self.fingerprint_fields = dict(RecordingLibrary.default_fingerprint_fields)
+        if fingerprint_fields is not None:
+            self.fingerprint_fields.update(fingerprint_fields)
+        self.last_sync = {}
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(self.schema)
+        self.lock = threading.RLock()
+        self.__subscribers = []
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def subscribe(self, callback):
+        """Call callback(change) for each LibraryChange found by later syncs."""
+        self.__subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self.__subscribers.remove(callback)
+
+    @staticmethod
+    def __json(item):
+        return json.dumps(item, default=lambda record: record.to_dict())
+
+    def __fingerprint(self, kind, item):
+        return json.dumps([item.get(f) for f in self.fingerprint_fields[kind]], default=str)
+
+    def __listing(self, kind, filt):
+        id_field, search, lookup = self.kinds[kind]
+        fields = tuple(self.fingerprint_fields[kind])
+        search_filter = api.SearchFilter()
+        if filt is not None:
+            payload = filt.get_payload() if isinstance(filt, api.SearchFilter) else dict(filt)
+            payload.pop('levelOfDetail', None)
+            payload.pop('responseTemplate', None)
+            search_filter.by_user_fields(payload)
+        search_filter.set_projection(api.Projection(**{kind: fields if id_field in fields else (id_field,) + fields}))
+        items = getattr(self.mind, search)(filt=search_filter, count=self.page_size, fetch_all=True)
+        return {item[id_field]: self.__fingerprint(kind, item) for item in items if id_field in item}
+
+    def __stored(self, kind):
+        with self.lock:
+            return dict(self.db.execute('SELECT id, fingerprint FROM item WHERE kind = ?', (kind,)))
+
+    def sync(self, kinds=None, filt=None):
+        """Bring the snapshot up to date for each kind ('recordingFolderItem' and/or 'recording'; both
+        by default) and return the list of LibraryChanges.
+
+        filt may narrow the listing searches.  A narrowed sync adds and updates the items it lists but
+        can only tell that an item was removed if the filter names its id (e.g. by_recording_id), so
+        other stored items are left alone; an unfiltered sync finds every removal."""
+        changes = []
+        for kind in (self.kinds if kinds is None else kinds):
+            changes.extend(self.__sync_kind(kind, filt))
+        for change in changes:
+            for callback in list(self.__subscribers):
+                callback(change)
+        return changes
+
+    @staticmethod
+    def __named_ids(id_field, filt):
+        payload = filt.get_payload() if isinstance(filt, api.SearchFilter) else dict(filt)
+        ids = payload.get(id_field, [])
+        return set(ids) if isinstance(ids, (list, tuple)) else {ids}
+
+    def __sync_kind(self, kind, filt):
+        id_field, search, lookup = self.kinds[kind]
+        current = self.__listing(kind, filt)
+        stored = self.__stored(kind)
+        added = [i for i in current if i not in stored]
+        changed = [i for i in current if i in stored and stored[i] != current[i]]
+        candidates = stored if filt is None else self.__named_ids(id_field, filt)
+        removed = [i for i in candidates if i in stored and i not in current]
+        details = getattr(self.mind, lookup)(added + changed, batch_size=self.batch_size) if added or changed else {}
+        old = {}
+        with self.lock:
+            for item_id in removed:
+                row = self.db.execute('SELECT data FROM item WHERE kind = ? AND id = ?', (kind, item_id)).fetchone()
+                old[item_id] = json.loads(row[0])
+        changes = [LibraryChange(kind, 'added', i, details[i]) for i in added if i in details]
+        changes.extend(LibraryChange(kind, 'changed', i, details[i]) for i in changed if i in details)
+        changes.extend(LibraryChange(kind, 'removed', i, old[i]) for i in removed)
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM item WHERE kind = ? AND id = ?', [(kind, i) for i in removed])
+            self.db.executemany('INSERT OR REPLACE INTO item VALUES (?, ?, ?, ?)',
+                                [(kind, i, current[i], self.__json(details[i])) for i in added + changed
+                                 if i in details])
+            if filt is None:
+                self.db.execute('INSERT OR REPLACE INTO sync_state VALUES (?, ?)', (kind, time.time()))
+        self.last_sync[kind] = {'listed': len(current),
+                                'fetched': len(details),
+                                'added': len(added),
+                                'changed': len(changed),
+                                'removed': len(removed)}
+        return changes
+
+    def items(self, kind):
+        """Return every stored full-detail item of kind."""
+        with self.lock:
+            return [json.loads(row[0]) for row in self.db.execute('SELECT data FROM item WHERE kind = ? ORDER BY id',
+                                                                  (kind,))]
+
+    def get(self, kind, item_id):
+        with self.lock:
+            row = self.db.execute('SELECT data FROM item WHERE kind = ? AND id = ?', (kind, item_id)).fetchone()
+        return None if row is None else json.loads(row[0])
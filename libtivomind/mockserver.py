@@ -0,0 +1,304 @@
+"""A local stand-in for a TiVo's Mind RPC service, for tests and benchmarks.
+
+MockMindServer accepts TLS connections, speaks the MRPC/2 framing used by MRPCSession and
+answers bodyAuthenticate, bodyConfigSearch and the *Search request types with synthetic, paged
+data, honouring id and start time filters and responseTemplate field lists.  Response latency,
+per-item payload size and random jitter (which makes replies to pipelined requests arrive out of
+order) are configurable.  Requests sent with ResponseCount "multiple" (event registrations) get
+their first response followed by event_count further responses event_interval seconds apart.  Any
+other request type is answered with a plain success response.
+"""
+import datetime
+import heapq
+import itertools
+import json
+import random
+import socket
+import ssl
+import threading
+import time
+
+import libtivomind.rpc as rpc
+
+
+class MockMindServer(object):
+
+    body_id = "tsn:000000000000000"
+    result_types = {"channelSearch": "channel",
+                    "offerSearch": "offer",
+                    "contentSearch": "content",
+                    "collectionSearch": "collection",
+                    "categorySearch": "category",
+                    "recordingSearch": "recording",
+                    "recordingFolderItemSearch": "recordingFolderItem",
+                    "whatsOnSearch": "whatsOn"}
+    id_fields = ("offerId", "contentId", "collectionId", "categoryId", "recordingId", "recordingFolderItemId",
+                 "stationId")
+
+    def __init__(self, cert_path, key_path=None, address="127.0.0.1", port=0, items=1000, item_size=0,
+                 latency=0.0, jitter=0.0, mak=None, stations=50, seed=0, event_count=3, event_interval=0.1,
+                 disconnect_after=None):
+        """items may be an int (the number of results for every search type) or a dict keyed by request
+        type.  latency is added to every reply and jitter is the upper bound of an additional random
+        delay, both in seconds.  If mak is set, bodyAuthenticate fails for any other key.  If
+        disconnect_after is set, each connection is dropped, unanswered, on receiving its request
+        after that many."""
+        self.ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.ctx.load_cert_chain(cert_path, key_path)
+        self.address = address
+        self.port = port
+        self.items = items
+        self.item_size = item_size
+        self.latency = latency
+        self.jitter = jitter
+        self.mak = mak
+        self.stations = stations
+        self.event_count = event_count
+        self.event_interval = event_interval
+        self.disconnect_after = disconnect_after
+        self.random = random.Random(seed)
+        self.epoch = datetime.datetime(2020, 1, 1)
+        self.requests = []
+        self.connections = 0
+        self.listener = None
+        self.__threads = []
+        self.__clients = []
+        self.__lock = threading.Lock()
+        self.__running = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.address, self.port))
+        self.listener.listen(64)
+        self.port = self.listener.getsockname()[1]
+        self.__running.set()
+        self.__spawn(self.__accept_loop)
+
+    def stop(self):
+        self.__running.clear()
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+        with self.__lock:
+            clients, self.__clients = self.__clients, []
+        for client in clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            client.close()
+        for thread in self.__threads:
+            if thread is not threading.current_thread():
+                thread.join(1)
+        self.__threads = []
+
+    def __spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        self.__threads.append(thread)
+        thread.start()
+
+    def __accept_loop(self):
+        while self.__running.is_set():
+            try:
+                sock, addr = self.listener.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.__spawn(self.__serve, sock)
+
+    def __serve(self, sock):
+        try:
+            client = self.ctx.wrap_socket(sock, server_side=True)
+        except (OSError, ssl.SSLError):
+            sock.close()
+            return
+        with self.__lock:
+            self.connections += 1
+            self.__clients.append(client)
+        sender = _DelayedSender(client)
+        self.__spawn(sender.run)
+        decoder = rpc.MRPCFrameDecoder()
+        try:
+            for served in itertools.count():
+                if not self.__running.is_set():
+                    break
+                headers, body = decoder.read_frame(client)
+                if self.disconnect_after is not None and served >= self.disconnect_after:
+                    break
+                request = json.loads(body)
+                with self.__lock:
+                    self.requests.append((headers, request))
+                response_type, response = self.respond(headers, request)
+                delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+                multiple = headers.get('ResponseCount') == 'multiple'
+                sender.send(self.encode_response(headers, response_type, response, is_final=not multiple), delay)
+                if multiple:
+                    for n in range(1, self.event_count + 1):
+                        response_type, response = self.respond(headers, request, sequence=n)
+                        sender.send(self.encode_response(headers, response_type, response, is_final=False),
+                                    delay + n * self.event_interval)
+        except (OSError, ValueError, rpc.MRPCError):
+            pass
+        finally:
+            sender.stop()
+            with self.__lock:
+                if client in self.__clients:
+                    self.__clients.remove(client)
+            client.close()
+
+    @staticmethod
+    def encode_response(request_headers, response_type, response, is_final=True):
+        response['type'] = response_type
+        body = json.dumps(response).encode()
+        headers = ("Type: response\r\n"
+                   "RpcId: {}\r\n"
+                   "SchemaVersion: {}\r\n"
+                   "Content-Type: application/json\r\n"
+                   "RequestType: {}\r\n"
+                   "IsFinal: {}\r\n\r\n").format(request_headers.get('RpcId', ''),
+                                                request_headers.get('SchemaVersion', ''),
+                                                request_headers.get('RequestType', ''),
+                                                'true' if is_final else 'false').encode()
+        return b"MRPC/2 " + str(len(headers)).encode() + b" " + str(len(body)).encode() + b"\r\n" + headers + body
+
+    def item_count(self, req_type):
+        if isinstance(self.items, dict):
+            return self.items.get(req_type, 0)
+        return self.items
+
+    def respond(self, headers, request, sequence=0):
+        """Return (response_type, response) for a decoded request; sequence numbers the responses
+        to an event registration."""
+        req_type = headers.get('RequestType', request.get('type'))
+        if req_type == 'bodyAuthenticate':
+            key = request.get('credential', {}).get('key')
+            if self.mak is not None and key != self.mak:
+                return 'bodyAuthenticateResponse', {'status': 'failure', 'message': 'Invalid credential.'}
+            return 'bodyAuthenticateResponse', {'status': 'success'}
+        if req_type == 'bodyConfigSearch':
+            return 'bodyConfigList', {'bodyConfig': [{'type': 'bodyConfig', 'bodyId': self.body_id}]}
+        if req_type in self.result_types:
+            return req_type[:-len('Search')] + 'List', self.search(req_type, request)
+        if req_type.endswith('EventRegister'):
+            return req_type[:-len('EventRegister')] + 'List', {'state': [{'type': 'tunerState', 'tunerId': 0,
+                                                                            'sequence': sequence}]}
+        return 'success', {}
+
+    def search(self, req_type, request):
+        result_type = self.result_types[req_type]
+        total = self.item_count(req_type)
+        id_filters = {f: request[f] if isinstance(request[f], list) else [request[f]]
+                      for f in self.id_fields if f in request}
+        start_range = (request.get('minStartTime', ''), request.get('maxStartTime', '\uffff'))
+        offset = request.get('offset', 0)
+        count = request.get('count', 20)
+        if id_filters or start_range != ('', '\uffff'):
+            matches = [i for i in range(total) if self.__matches(result_type, i, id_filters, start_range)]
+            indexes = matches[offset:offset + count]
+            bottom = offset + count >= len(matches)
+        else:
+            indexes = range(offset, min(offset + count, total))
+            bottom = offset + count >= total
+        response = {'isBottom': bottom}
+        if len(indexes) > 0:
+            response[result_type] = [self.make_item(result_type, i) for i in indexes]
+        if 'responseTemplate' in request:
+            templates = {t['typeName']: t['fieldName'] for t in request['responseTemplate']}
+            response = self.project(response, req_type[:-len('Search')] + 'List', templates)
+        return response
+
+    @classmethod
+    def project(cls, value, type_name, templates):
+        """Apply responseTemplate field lists to a response; nested objects without a 'type' are
+        matched by their field name."""
+        if isinstance(value, list):
+            return [cls.project(v, type_name, templates) for v in value]
+        if not isinstance(value, dict):
+            return value
+        type_name = value.get('type', type_name)
+        fields = templates.get(type_name)
+        return {k: cls.project(v, k, templates) for k, v in value.items()
+                if fields is None or k in fields or k == 'type'}
+
+    def __matches(self, result_type, index, id_filters, start_range):
+        item = self.make_item(result_type, index)
+        if 'startTime' in item and not start_range[0] <= item['startTime'] <= start_range[1]:
+            return False
+        return all(item.get(f, item.get('channel', {}).get(f)) in ids for f, ids in id_filters.items())
+
+    def make_item(self, result_type, index):
+        """Return the synthetic result at index for result_type; results are deterministic."""
+        station = index % self.stations
+        item = {'type': result_type,
+                'title': 'Title {:d}'.format(index % 997),
+                'collectionId': 'tivo:cl.{:d}'.format(index % 503),
+                'contentId': 'tivo:ct.{:d}'.format(index % 2003)}
+        if result_type == 'channel':
+            item = {'type': 'channel',
+                    'stationId': 'tivo:st.{:d}'.format(index),
+                    'channelNumber': '{:d}'.format(index + 2),
+                    'callSign': 'CH{:d}'.format(index)}
+        elif result_type in ('offer', 'whatsOn'):
+            start = self.epoch + datetime.timedelta(minutes=30 * (index // self.stations))
+            item.update({'offerId': 'tivo:of.{:d}'.format(index),
+                         'startTime': rpc.MRPCSession.get_date_string(start),
+                         'duration': 1800,
+                         'channel': {'stationId': 'tivo:st.{:d}'.format(station),
+                                     'channelNumber': '{:d}'.format(station + 2)}})
+        elif result_type == 'recording':
+            item.update({'recordingId': 'tivo:rc.{:d}'.format(index), 'state': 'complete'})
+        elif result_type == 'recordingFolderItem':
+            item.update({'recordingFolderItemId': 'tivo:rf.{:d}'.format(index),
+                         'childRecordingId': 'tivo:rc.{:d}'.format(index)})
+        elif result_type == 'category':
+            item = {'type': 'category', 'categoryId': 'tivo:ca.{:d}'.format(index),
+                    'label': 'Category {:d}'.format(index)}
+        elif result_type == 'collection':
+            item['collectionId'] = 'tivo:cl.{:d}'.format(index)
+        elif result_type == 'content':
+            item['contentId'] = 'tivo:ct.{:d}'.format(index)
+        if self.item_size:
+            item['description'] = 'x' * self.item_size
+        return item
+
+
+class _DelayedSender(object):
+    """Writes frames to a client socket once each frame's delay has elapsed."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.heap = []
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.stopped = False
+
+    def send(self, frame, delay=0.0):
+        with self.cond:
+            heapq.heappush(self.heap, (time.monotonic() + delay, next(self.seq), frame))
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.stopped and (not self.heap or self.heap[0][0] > time.monotonic()):
+                    self.cond.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                if self.stopped:
+                    return
+                due, seq, frame = heapq.heappop(self.heap)
+            try:
+                self.sock.sendall(frame)
+            except OSError:
+                return
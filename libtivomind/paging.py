@@ -0,0 +1,155 @@
+import collections
+import random
+import threading
+import time
+
+
+class AdaptivePageSizer(object):
+    """Tunes the page size of fetch_all searches and iter_* generators between pages, whether
+    pages are fetched one at a time, pipelined (page_window > 1) or resumed (retry).
+
+    After each page the next count is scaled toward whichever is smaller of the count that would
+    take target_latency seconds and the count that would return target_bytes of body (measured
+    from the MRPC/2 preamble), never growing or shrinking by more than a factor of two per page
+    and staying within [min_count, max_count].  Tuned sizes are remembered per request type and
+    device so later searches start from them."""
+
+    def __init__(self, target_latency=0.5, target_bytes=256 * 1024, min_count=10, max_count=250):
+        self.target_latency = target_latency
+        self.target_bytes = target_bytes
+        self.min_count = min_count
+        self.max_count = max_count
+        self.__sizes = {}
+        self.__lock = threading.Lock()
+
+    def clamp(self, count):
+        return max(self.min_count, min(self.max_count, int(count)))
+
+    def count(self, key, default=20):
+        with self.__lock:
+            return self.__sizes.get(key, self.clamp(default))
+
+    def update(self, key, count, items, elapsed, body_size):
+        """Record a page of items fetched with count in elapsed seconds and return the next count."""
+        if items < count:
+            # A short page is the end of the results and says little about the best size.
+            return self.count(key, count)
+        targets = []
+        if self.target_latency and elapsed > 0:
+            targets.append(count * self.target_latency / elapsed)
+        if self.target_bytes and body_size > 0:
+            targets.append(count * self.target_bytes / body_size)
+        target = min(targets) if targets else count
+        next_count = self.clamp(min(max(target, count / 2), count * 2))
+        with self.__lock:
+            self.__sizes[key] = next_count
+        return next_count
+
+    def sizes(self):
+        with self.__lock:
+            return dict(self.__sizes)
+
+
+class PageWindow(object):
+    """The offset, count and in-flight bookkeeping of one paged search, shared by the blocking and
+    asyncio Minds, which do the sending and waiting themselves:
+
+        while pages.wants():
+            pages.sent(session.send_request(req_type, pages.request()))
+        headers, body = session.get_response(pages.next_id())
+        last = pages.received(headers, body, page)
+
+    Up to window requests are kept in flight from offset and their replies must be received in the
+    order they were sent.  Once a page reports isBottom (or comes back empty) no further requests
+    are wanted and the over-fetched ones are cancelled with cancel(rpc_id).  If a page comes back
+    short without reaching the bottom, the requests in flight are cancelled and paging resumes from
+    the actual offset.  With a sizer (an AdaptivePageSizer), each new request uses the count tuned,
+    under key, from the pages received so far."""
+
+    def __init__(self, payload, cancel, count=20, offset=0, window=1, sizer=None, key=None):
+        self.payload = payload
+        self.cancel = cancel
+        self.window = max(window, 1)
+        self.sizer = sizer
+        self.key = key
+        self.count = count if sizer is None else sizer.count(key, count)
+        self.offset = offset
+        self.pending = collections.deque()
+        self.done = False
+        self.__waiting = None
+
+    def wants(self):
+        """Return True while another request should be sent."""
+        return not self.done and len(self.pending) < self.window
+
+    def request(self):
+        """Return the payload for the next page; pass the RpcId it is sent with to sent()."""
+        self.payload['count'] = self.count
+        self.payload['offset'] = self.offset
+        return self.payload
+
+    def sent(self, rpc_id):
+        self.pending.append((self.offset, self.count, time.monotonic(), rpc_id))
+        self.offset += self.count
+
+    def next_id(self):
+        """Return the RpcId of the next page to wait for."""
+        self.__waiting = time.monotonic()
+        return self.pending[0][3]
+
+    def received(self, headers, body, page):
+        """Record the reply to next_id(), with page the results taken from body, and return True if
+        it was the last page.  The sizer is given the time from when the page was both sent and
+        waited for, so with several pages in flight the time a reply spent queued behind earlier
+        ones, or ready while the caller was busy, is not taken for latency."""
+        page_offset, page_count, sent, rpc_id = self.pending.popleft()
+        if len(page) == 0 or 'isBottom' not in body or body['isBottom']:
+            self.done = True
+            self.close()
+            return True
+        if self.sizer is not None:
+            waited = time.monotonic() - max(sent, self.__waiting)
+            self.count = self.sizer.update(self.key, page_count, len(page), waited, getattr(headers, 'b_size', 0))
+        if len(page) < page_count:
+            self.close()
+            self.offset = page_offset + len(page)
+        return False
+
+    def close(self):
+        """Cancel the requests still in flight."""
+        while self.pending:
+            self.cancel(self.pending.popleft()[3])
+
+
+class RetryPolicy(object):
+    """Bounded exponential backoff for resuming fetch_all searches after a lost connection.
+
+    The n-th consecutive retry waits base_delay * 2 ** (n - 1) seconds, capped at max_delay and
+    stretched by up to jitter (a fraction) at random; a fetch gives up and raises the connection
+    error after max_retries consecutive failed attempts.  retries counts reconnection attempts and
+    resumes counts fetches that continued from a later offset instead of starting over."""
+
+    def __init__(self, max_retries=5, base_delay=0.5, max_delay=30.0, jitter=0.1):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.retries = 0
+        self.resumes = 0
+        self.__lock = threading.Lock()
+
+    def delay(self, attempt):
+        delay = min(self.base_delay * 2 ** (attempt - 1), self.max_delay)
+        return delay * (1 + random.uniform(0, self.jitter))
+
+    def retried(self):
+        with self.__lock:
+            self.retries += 1
+
+    def resumed(self):
+        with self.__lock:
+            self.resumes += 1
+
+    def stats(self):
+        with self.__lock:
+            return {"retries": self.retries, "resumes": self.resumes}
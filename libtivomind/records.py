@@ -0,0 +1,182 @@
+"""Compact records for large result sets.
+
+A Record keeps the commonly used fields of a Mind result in __slots__, interning repeated strings
+such as titles, station and collection ids, and keeps every other field (images, credits,
+descriptions and similar nested objects) as one encoded JSON blob that is only decoded when one of
+those fields is first read.  Records support the read side of the dict interface (item['title'],
+item.get(), 'title' in item) as well as attribute access, so code written against plain results
+keeps working; to_dict() returns the equivalent plain dict.
+
+Records trade CPU for memory.  Each page is still parsed in full, and every record then encodes
+its remaining fields again, so converting a page takes several times as long as parsing it
+(roughly 15-20 microseconds per offer, about four to six times the parse alone).  They pay off
+for large result sets that are held in memory, not for results that are consumed and discarded.
+"""
+import sys
+
+import libtivomind.rpc as rpc
+
+# The stdlib codec, because orjson over-allocates the small bytes objects it returns.
+_codec = rpc.JSONCodec()
+_missing = object()
+
+
+class Record(object):
+
+    __slots__ = ('type', '_extra')
+    fields = ('type',)
+    interned = frozenset(('type',))
+
+    def __init__(self, data):
+        extra = {}
+        for key, value in data.items():
+            if key in self.fields:
+                if isinstance(value, str) and key in self.interned:
+                    value = sys.intern(value)
+                elif isinstance(value, dict) and key in record_types:
+                    value = record_types[key](value)
+                setattr(self, key, value)
+            else:
+                extra[key] = value
+        self._extra = _codec.dumps(extra) if extra else None
+
+    def __extras(self):
+        if isinstance(self._extra, bytes):
+            self._extra = _codec.loads(self._extra)
+        return self._extra if self._extra is not None else {}
+
+    def __slot_value(self, key):
+        if key in self.fields:
+            try:
+                return object.__getattribute__(self, key)
+            except AttributeError:
+                pass
+        return _missing
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        value = self.__extras().get(name, _missing)
+        if value is not _missing:
+            return value
+        if name in self.fields:
+            return None
+        raise AttributeError(name)
+
+    def __getitem__(self, key):
+        value = self.__slot_value(key)
+        if value is _missing:
+            return self.__extras()[key]
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        if key in self.fields:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self.__extras()[key] = value
+
+    def __contains__(self, key):
+        return self.__slot_value(key) is not _missing or key in self.__extras()
+
+    def keys(self):
+        return [k for k in self.fields if self.__slot_value(k) is not _missing] + list(self.__extras())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def copy(self):
+        """Return a shallow copy, as dict.copy() does; setting a field on it leaves this record unchanged."""
+        clone = object.__new__(type(self))
+        clone.__setstate__(self.__getstate__())
+        if isinstance(clone._extra, dict):
+            clone._extra = dict(clone._extra)
+        return clone
+
+    def to_dict(self):
+        """Return the record as a plain dict, converting nested records too."""
+        data = {}
+        for key in self.keys():
+            value = self[key]
+            data[key] = value.to_dict() if isinstance(value, Record) else value
+        return data
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.to_dict()
+        return isinstance(other, dict) and self.to_dict() == other
+
+    __hash__ = None
+
+    def __getstate__(self):
+        state = {k: v for k, v in ((k, self.__slot_value(k)) for k in self.fields) if v is not _missing}
+        state['_extra'] = self._extra
+        return state
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+
+    def __repr__(self):
+        id_field = self.fields[1] if len(self.fields) > 1 else 'type'
+        return '{}({}={!r})'.format(type(self).__name__, id_field, self.get(id_field))
+
+
+def _record_type(name, fields, interned=()):
+    fields = tuple(fields)
+    return type(name, (Record,), {'__slots__': fields,
+                                  'fields': ('type',) + fields,
+                                  'interned': frozenset(('type',) + tuple(interned))})
+
+
+Channel = _record_type('Channel', ('stationId', 'channelId', 'channelNumber', 'callSign', 'name', 'isReceived'),
+                       interned=('stationId', 'channelId', 'channelNumber', 'callSign', 'name'))
+Offer = _record_type('Offer', ('offerId', 'contentId', 'collectionId', 'title', 'subtitle', 'startTime', 'duration',
+                               'channel', 'isEpisode', 'collectionType'),
+                     interned=('collectionId', 'title', 'collectionType'))
+Recording = _record_type('Recording', ('recordingId', 'contentId', 'collectionId', 'offerId', 'title', 'subtitle',
+                                       'startTime', 'duration', 'state', 'channel', 'collectionType'),
+                         interned=('collectionId', 'title', 'state', 'collectionType'))
+RecordingFolderItem = _record_type('RecordingFolderItem', ('recordingFolderItemId', 'childRecordingId',
+                                                           'collectionId', 'contentId', 'title', 'folderType',
+                                                           'folderItemCount', 'startTime', 'recordingStatusType'),
+                                   interned=('collectionId', 'title', 'folderType', 'recordingStatusType'))
+Collection = _record_type('Collection', ('collectionId', 'title', 'collectionType', 'description'),
+                          interned=('collectionId', 'title', 'collectionType'))
+Content = _record_type('Content', ('contentId', 'collectionId', 'title', 'subtitle', 'description', 'seasonNumber',
+                                   'episodeNum', 'collectionType'),
+                       interned=('collectionId', 'title', 'collectionType'))
+Category = _record_type('Category', ('categoryId', 'label', 'parentCategoryId', 'topLevel'),
+                        interned=('categoryId', 'label', 'parentCategoryId'))
+WhatsOn = _record_type('WhatsOn', ('channelIdentifier', 'offerId', 'contentId', 'collectionId', 'playbackType'),
+                       interned=('collectionId', 'playbackType'))
+
+# Record classes keyed by result type (the name of the result array and of each result's 'type').
+record_types = {'channel': Channel,
+                'offer': Offer,
+                'recording': Recording,
+                'recordingFolderItem': RecordingFolderItem,
+                'collection': Collection,
+                'content': Content,
+                'category': Category,
+                'whatsOn': WhatsOn}
+
+
+# Types search results may have, for code that accepts either a result or an id.
+mapping_types = (dict, Record)
+
+
+def to_records(result_type, items):
+    """Convert a page of plain results to records of the class for result_type."""
+    cls = record_types.get(result_type, Record)
+    return [cls(item) for item in items]
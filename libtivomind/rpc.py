@@ -1,16 +1,27 @@
-import collections
-import io
+import concurrent.futures
 import json
+import logging
+import queue
 import random
 import re
+import select
 import socket
 import ssl
+import threading
+import time
+
+# Sessions and frame decoders created with debug=True log each frame they read here, at DEBUG level.
+log = logging.getLogger(__name__)
 
 
 class MRPCError(Exception):
     pass
 
 
+class MRPCTimeout(MRPCError):
+    pass
+
+
 class MRPCCredential(object):
 
     TYPES = {"MAK_CREDENTIAL": ("mak", ),
@@ -58,139 +69,716 @@ class MRPCCredential(object):
 
 
 class SocketMaker(object):
+    """Creates TLS sockets from one SSLContext, remembering the last TLS session for each server
+    so later connections can resume it instead of doing a full handshake."""
+
+    __shared = {}
+    __shared_lock = threading.Lock()
 
     def __init__(self, cert_path, cert_password):
         self.ctx = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH)
         self.ctx.check_hostname = False
         self.ctx.verify_mode = ssl.CERT_NONE
         self.ctx.load_cert_chain(cert_path, password=cert_password)
+        self.tls_sessions = {}
 
-    def get_socket(self):
+    def get_socket(self, server=None):
         s = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
-        return self.ctx.wrap_socket(s)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return self.ctx.wrap_socket(s, session=self.tls_sessions.get(server))
+
+    def save_session(self, server, sock):
+        """Keep the TLS session of a connected socket for resumption by the next get_socket(server)."""
+        if sock.session is not None:
+            self.tls_sessions[server] = sock.session
+
+    @staticmethod
+    def shared(cert_path, cert_password):
+        """Return the SocketMaker for a certificate, creating it (and its SSLContext) only once per process."""
+        with SocketMaker.__shared_lock:
+            key = (cert_path, cert_password)
+            if key not in SocketMaker.__shared:
+                SocketMaker.__shared[key] = SocketMaker(cert_path, cert_password)
+            return SocketMaker.__shared[key]
+
+
+class JSONCodec(object):
+    """Encodes request payloads to UTF-8 JSON bytes and decodes response bodies, using the stdlib json module."""
+
+    name = "json"
+
+    @staticmethod
+    def dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+
+class OrjsonCodec(JSONCodec):
+    """A JSONCodec backed by the optional orjson package."""
+
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self.dumps = orjson.dumps
+        self.loads = orjson.loads
+
+
+def default_codec():
+    """Return the fastest available JSONCodec, falling back to the stdlib json module."""
+    try:
+        return OrjsonCodec()
+    except ImportError:
+        return JSONCodec()
+
+
+class MRPCHeaders(dict):
+    """Parsed response headers, also carrying the header and body sizes from the MRPC/2 preamble."""
+
+    __slots__ = ('h_size', 'b_size')
+
+    def __init__(self, headers, h_size=0, b_size=0):
+        super().__init__(headers)
+        self.h_size = h_size
+        self.b_size = b_size
+
+
+class MRPCFrameDecoder(object):
+
+    preamble_pat = re.compile(rb"MRPC/2 (?P<h_size>\d+) (?P<b_size>\d+)\r\n")
+
+    def __init__(self, buffer_size=65536, debug=False):
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.debug = debug
+        self.__sizes = None
+        self.__headers = None
+        # When clock is set (by an instrumented session) the arrival time of each frame's first
+        # byte is kept in frame_first_byte.
+        self.clock = None
+        self.frame_first_byte = None
+        # If set, on_headers(headers, first_byte) is called as soon as a frame's headers have
+        # arrived, while its body may still be on the way.
+        self.on_headers = None
+        self.__frame_started = None
+        self.__last_fill = None
+
+    @property
+    def pending(self):
+        return self.end - self.start
+
+    def reset(self):
+        self.start = 0
+        self.end = 0
+        self.__sizes = None
+        self.__headers = None
+        self.__frame_started = None
+
+    def __filled(self):
+        self.__last_fill = self.clock()
+        if self.__frame_started is None:
+            self.__frame_started = self.__last_fill
+
+    def __reserve(self, size):
+        """Make room for at least size bytes after self.end, compacting or growing the buffer."""
+        if len(self.buffer) - self.end >= size:
+            return
+        live = self.end - self.start
+        if len(self.buffer) - live < size:
+            buffer = bytearray(max(2 * len(self.buffer), live + size))
+            buffer[:live] = self.view[self.start:self.end]
+            self.view.release()
+            self.buffer = buffer
+            self.view = memoryview(self.buffer)
+        elif live > 0:
+            self.buffer[:live] = self.buffer[self.start:self.end]
+        self.start = 0
+        self.end = live
+
+    def feed(self, data):
+        """Append bytes that were read elsewhere, e.g. from an asyncio stream."""
+        self.__reserve(len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+        if self.clock is not None:
+            self.__filled()
+
+    def fill(self, sock, min_free=4096):
+        self.__reserve(min_free)
+        n = sock.recv_into(self.view[self.end:])
+        if n == 0:
+            raise MRPCError("Connection closed by remote host.")
+        self.end += n
+        if self.clock is not None:
+            self.__filled()
+        return n
+
+    def next_frame(self):
+        """Return (headers, body) for the next complete frame in the buffer, or None.
+
+        The headers are returned as an MRPCHeaders dict and the body as bytes ready for json.loads;
+        any bytes following the frame are kept for the next call."""
+        if self.__sizes is None:
+            m = self.preamble_pat.search(self.buffer, self.start, self.end)
+            if m is None:
+                return None
+            self.__sizes = (m.end() - self.start, int(m.group('h_size')), int(m.group('b_size')))
+            if self.debug:
+                log.debug("RPC Response (Offset: %d, H Size: %d, B Size: %d)", *self.__sizes)
+        h_offset, h_size, b_size = self.__sizes
+        if self.debug:
+            log.debug("RPC Response (Bytes Loaded: %d)", self.end - self.start - h_offset)
+        h_start = self.start + h_offset
+        b_start = h_start + h_size
+        if self.__headers is None and self.end >= b_start:
+            self.__headers = MRPCHeaders(MRPCProtocol.parse_headers(bytes(self.view[h_start:b_start]).decode()),
+                                         h_size, b_size)
+            if self.on_headers is not None:
+                self.on_headers(self.__headers, self.__frame_started)
+        if self.end - self.start < h_offset + h_size + b_size:
+            self.__reserve(self.start + h_offset + h_size + b_size - self.end)
+            return None
+        b_end = b_start + b_size
+        headers = self.__headers
+        body = bytes(self.view[b_start:b_end])
+        self.__sizes = None
+        self.__headers = None
+        self.start = b_end
+        if self.start == self.end:
+            self.start = self.end = 0
+        if self.clock is not None:
+            self.frame_first_byte = self.__frame_started
+            self.__frame_started = self.__last_fill if self.start != self.end else None
+        return headers, body
+
+    def read_frame(self, sock):
+        frame = self.next_frame()
+        while frame is None:
+            self.fill(sock)
+            frame = self.next_frame()
+        return frame
+
+
+class MRPCEvent(object):
+    """Sizes and timings of one RPC, passed to a session's observer.
+
+    Sizes are in bytes and times in seconds: serialize_time is spent encoding the request,
+    first_byte_time and network_time run from the end of encoding to the first and last byte of
+    the response, and parse_time is spent decoding the response JSON.  sent and headers_received
+    are time.perf_counter() readings taken when the request was encoded and when the response's
+    headers had arrived."""
+
+    __slots__ = ('request_type', 'rpc_id', 'request_header_size', 'request_body_size',
+                 'response_header_size', 'response_body_size', 'serialize_time', 'first_byte_time',
+                 'network_time', 'parse_time', 'sent', 'headers_received')
 
+    def __init__(self, request_type, rpc_id, request_header_size=0, request_body_size=0):
+        self.request_type = request_type
+        self.rpc_id = rpc_id
+        self.request_header_size = request_header_size
+        self.request_body_size = request_body_size
+        self.response_header_size = 0
+        self.response_body_size = 0
+        self.serialize_time = 0.0
+        self.first_byte_time = None
+        self.network_time = None
+        self.parse_time = None
+        self.sent = None
+        self.headers_received = None
 
-class MRPCSession(object):
+    def __repr__(self):
+        return "MRPCEvent({})".format(", ".join("{}={!r}".format(k, getattr(self, k)) for k in self.__slots__))
+
+
+class MRPCProtocol(object):
+    """Connection state and request encoding shared by the blocking and asyncio sessions."""
 
     eol = '\r\n'
     response_count = {True: "multiple", False: "single"}
     schema_version = "17"
-    proto_pat = re.compile("^.*MRPC/2 (?P<h_size>\d+) (?P<b_size>\d+)\r\n")
+    # bodyId found for each (address, port, credential), so reconnects can skip bodyConfigSearch.
+    body_ids = {}
 
     def __init__(self, socket_maker, address, credential, port=1413, debug=False):
         self.sm = socket_maker
         self.credential = credential
         self.address = address
         self.port = port
-        self.socket = None
         self.session_id = random.randint(0, 2**32 - 1)
         self.rpc_id = 0
         self.body_id = ""
         self.debug = debug
-        self.queue = collections.deque()
+        self.decoder = MRPCFrameDecoder(debug=debug)
+        self.connections = 0
+        self.codec = default_codec()
+        self.__observer = None
+        self.__events = {}
+        self.__template = None
 
-    def connect(self):
-        self.socket = self.sm.get_socket()
-        self.socket.connect((self.address, self.port))
-        h, b = self.do_auth()
-        if 'status' not in b or b["status"] != "success":
-            import pprint; pprint.pprint(b); pprint.pprint(self.credential.payload())
-            self.close()
+    @property
+    def observer(self):
+        """An optional object notified of each RPC (see libtivomind.instrument.MRPCObserver)."""
+        return self.__observer
+
+    @observer.setter
+    def observer(self, observer):
+        self.__observer = observer
+        self.__events = {}
+        self.decoder.clock = None if observer is None else time.perf_counter
+        self.decoder.on_headers = None if observer is None else self.__headers_received
+
+    def _encode_observed(self, req_type, payload_json, multiple_responses=False):
+        """encode_request, also reporting the request to the observer; only used when one is installed."""
+        started = time.perf_counter()
+        rpc_id, request = self.encode_request(req_type, payload_json, multiple_responses)
+        encoded = time.perf_counter()
+        h_size, b_size = request[7:request.index(b'\r\n')].split()
+        event = MRPCEvent(req_type, rpc_id, int(h_size), int(b_size))
+        event.serialize_time = encoded - started
+        event.sent = encoded
+        self.__events[rpc_id] = event
+        self.__observer.on_send(event)
+        return rpc_id, request
+
+    def __headers_received(self, headers, first_byte):
+        """Called by the decoder as soon as a response's headers are in, before its body may be."""
+        if self.__observer is None:
+            return
+        rpc_id = int(headers['RpcId'])
+        event = self.__events.get(rpc_id)
+        if event is None:
+            event = self.__events[rpc_id] = MRPCEvent(headers.get('RequestType'), rpc_id)
+        event.headers_received = time.perf_counter()
+        event.response_header_size = headers.h_size
+        event.response_body_size = headers.b_size
+        if event.sent is not None and first_byte is not None:
+            event.first_byte_time = max(first_byte - event.sent, 0.0)
+        self.__observer.on_first_byte(event)
+
+    def _decode_response(self, headers, body):
+        """Parse a response body, reporting its timings to the observer if one is installed."""
+        if self.__observer is None:
+            return self.codec.loads(body)
+        received = time.perf_counter()
+        rpc_id = int(headers['RpcId'])
+        event = self.__events.pop(rpc_id, None) or MRPCEvent(headers.get('RequestType'), rpc_id)
+        if event.headers_received is None:
+            # The observer was installed while this frame was being read.
+            event.response_header_size = getattr(headers, 'h_size', 0)
+            event.response_body_size = getattr(headers, 'b_size', len(body))
+            if event.sent is not None and self.decoder.frame_first_byte is not None:
+                event.first_byte_time = max(self.decoder.frame_first_byte - event.sent, 0.0)
+            self.__observer.on_first_byte(event)
+        if event.sent is not None:
+            event.network_time = received - event.sent
+        response = self.codec.loads(body)
+        event.parse_time = time.perf_counter() - received
+        self.__observer.on_response(event)
+        return response
+
+    def _observe_dropped(self, rpc_id):
+        """Forget the event of a response that is discarded without being decoded."""
+        if self.__observer is not None:
+            self.__events.pop(rpc_id, None)
+
+    def _observe_out_of_order(self, rpc_id):
+        if self.__observer is not None:
+            self.__observer.on_out_of_order(rpc_id)
+
+    def _observe_connect(self):
+        if self.connections > 0 and self.__observer is not None:
+            self.__observer.on_reconnect(self)
+        self.connections += 1
+
+    def __header_template(self):
+        """Return the request header block split around its per-request values, built once per session."""
+        key = (self.session_id, self.schema_version)
+        if self.__template is None or self.__template[0] != key:
+            eol = self.eol
+            self.__template = (
+                key,
+                ("Type: request" + eol + "RpcId: ").encode(),
+                (eol + "SchemaVersion: {}".format(self.schema_version) + eol +
+                 "Content-Type: application/json" + eol + "RequestType: ").encode(),
+                {flag: (eol + "ResponseCount: " + count + eol + "BodyId: ").encode()
+                 for flag, count in self.response_count.items()},
+                (eol + "X-ApplicationName: Quicksilver" + eol +
+                 "X-ApplicationVersion: 1.2" + eol +
+                 "X-ApplicationSessionId: 0x{:x}".format(self.session_id) + eol + eol).encode())
+        return self.__template
+
+    def encode_request(self, req_type, payload_json, multiple_responses=False):
+        """Return (rpc_id, request_bytes) for a request, allocating the next RpcId.
+
+        The payload is not modified; the request type is added to a copy before encoding."""
+        key, type_prefix, type_line, count_lines, suffix = self.__header_template()
+        payload = dict(payload_json)
+        payload['type'] = req_type
+        body = self.codec.dumps(payload)
+        headers = b"".join((type_prefix, str(self.rpc_id).encode(), type_line, req_type.encode(),
+                            count_lines[multiple_responses], str(payload_json.get("bodyId", "")).encode(), suffix))
+        request = b"".join((b"MRPC/2 ", str(len(headers)).encode(), b" ", str(len(body)).encode(), b"\r\n",
+                            headers, body, b"\n"))
+        self.rpc_id += 1
+        return self.rpc_id - 1, request
+
+    def _body_id_key(self):
+        return self.address, self.port, json.dumps(self.credential.payload(), sort_keys=True)
+
+    def cached_body_id(self):
+        return MRPCProtocol.body_ids.get(self._body_id_key())
+
+    def remember_body_id(self, body_id):
+        if body_id and body_id != "-":
+            MRPCProtocol.body_ids[self._body_id_key()] = body_id
+        else:
+            MRPCProtocol.body_ids.pop(self._body_id_key(), None)
+
+    def check_auth(self, auth_response):
+        if 'status' not in auth_response or auth_response["status"] != "success":
+            MRPCProtocol.body_ids.pop(self._body_id_key(), None)
             raise MRPCError("Auth Failure")
+
+    def web_body_id(self, auth_response):
+        """Return the bodyId for a WEB_CREDENTIAL from the devices listed in the auth response."""
+        try:
+            devices = [d for d in auth_response["deviceId"] if d["friendlyName"] == self.credential.unit_name]
+            if len(devices) > 0:
+                return devices[0]["id"]
+            else:
+                raise KeyError("No device entry matching unit_name.")
+        except KeyError:
+            return "-"
+
+    @staticmethod
+    def config_body_id(config_response):
+        try:
+            return config_response['bodyConfig'][0]['bodyId']
+        except KeyError:
+            return "-"
+
+    @staticmethod
+    def parse_headers(buffer):
+        return dict([line.split(': ', 1) for line in buffer.split('\r\n') if len(line) > 0])
+
+    @staticmethod
+    def get_date_string(date_time):
+        return date_time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+class MRPCResponseStore(object):
+    """The outstanding requests of a session, keyed by RpcId.
+
+    Each request is added when it is sent, with an optional deadline, and holds either the reply
+    read for it before anyone asked (MRPCSession) or the future its reply resolves
+    (MultiplexedMRPCSession).  A request that is cancelled, or whose deadline has passed, is
+    removed, so its late reply finds no entry and is dropped.  At most max_size requests may be
+    outstanding: add() waits up to timeout seconds for one to finish and then raises MRPCError.
+    A sender that must not wait while holding a lock can reserve() room first and pass
+    reserved=True to add()."""
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.max_depth = 0
+        self.dropped = 0
+        self.expired = 0
+        self.cancelled = 0
+        self.__entries = {}
+        self.__reserved = 0
+        self.__cond = threading.Condition()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __contains__(self, rpc_id):
+        return rpc_id in self.__entries
+
+    def __has_room(self):
+        return len(self.__entries) + self.__reserved < self.max_size
+
+    def __wait_for_room(self, timeout, failure):
+        if not self.__has_room():
+            self.__expire(time.monotonic())
+            if not self.__cond.wait_for(lambda: self.__has_room() or failure() is not None, timeout):
+                raise MRPCError("{:d} requests are already outstanding.".format(len(self.__entries)))
+        if failure() is not None:
+            raise failure()
+
+    def add(self, rpc_id, value=None, deadline=None, timeout=0, reserved=False):
+        with self.__cond:
+            if reserved:
+                self.__reserved -= 1
+            else:
+                self.__wait_for_room(timeout, lambda: None)
+            self.__entries[rpc_id] = [deadline, value]
+            self.max_depth = max(self.max_depth, len(self.__entries))
+
+    def reserve(self, timeout=0, failure=lambda: None):
+        """Wait up to timeout seconds for room for one more request and hold it for a later
+        add(reserved=True) or release().  The wait ends early, raising the exception, as soon as
+        failure() returns one; clear() wakes every waiter to check."""
+        with self.__cond:
+            self.__wait_for_room(timeout, failure)
+            self.__reserved += 1
+
+    def release(self):
+        """Give back room taken by reserve() that will not be used."""
+        with self.__cond:
+            self.__reserved -= 1
+            self.__cond.notify()
+
+    def get(self, rpc_id, default=None):
+        entry = self.__entries.get(rpc_id)
+        return default if entry is None else entry[1]
+
+    def deadline(self, rpc_id):
+        entry = self.__entries.get(rpc_id)
+        return None if entry is None else entry[0]
+
+    def set(self, rpc_id, value):
+        """Store value for an outstanding request; returns False, counting a dropped reply, otherwise."""
+        entry = self.__entries.get(rpc_id)
+        if entry is None:
+            self.dropped += 1
+            return False
+        entry[1] = value
+        return True
+
+    def first(self):
+        """Return the RpcId of the oldest request holding a value, or None."""
+        return next((rpc_id for rpc_id, entry in list(self.__entries.items()) if entry[1] is not None), None)
+
+    def pop(self, rpc_id, default=None):
+        with self.__cond:
+            entry = self.__entries.pop(rpc_id, None)
+            self.__cond.notify()
+        return default if entry is None else entry[1]
+
+    def cancel(self, rpc_id):
+        """Forget a request; a reply that arrives for it later is dropped."""
+        with self.__cond:
+            if self.__entries.pop(rpc_id, None) is not None:
+                self.cancelled += 1
+                self.__cond.notify()
+
+    def expire(self):
+        """Remove, and return the values of, the requests whose deadline has passed."""
+        with self.__cond:
+            return self.__expire(time.monotonic())
+
+    def __expire(self, now):
+        expired = [rpc_id for rpc_id, entry in self.__entries.items() if entry[0] is not None and entry[0] <= now]
+        values = [self.__entries.pop(rpc_id)[1] for rpc_id in expired]
+        self.expired += len(expired)
+        if expired:
+            self.__cond.notify_all()
+        return values
+
+    def clear(self):
+        """Remove every request, returning their values."""
+        with self.__cond:
+            entries, self.__entries = self.__entries, {}
+            self.__cond.notify_all()
+        return [entry[1] for entry in entries.values()]
+
+    def stats(self):
+        return {"outstanding": len(self.__entries),
+                "max_depth": self.max_depth,
+                "dropped": self.dropped,
+                "expired": self.expired,
+                "cancelled": self.cancelled}
+
+
+class MRPCSession(MRPCProtocol):
+    """A blocking MRPC session for use by one thread at a time.
+
+    Replies that arrive for a request other than the one being waited on are kept in an
+    MRPCResponseStore until asked for.  With a timeout (in seconds), every request gets that long to
+    be answered; get_response then raises MRPCTimeout and the request's late reply is dropped."""
+
+    def __init__(self, socket_maker, address, credential, port=1413, debug=False, timeout=None, max_pending=256):
+        super().__init__(socket_maker, address, credential, port=port, debug=debug)
+        self.socket = None
+        self.timeout = timeout
+        self.store = MRPCResponseStore(max_size=max_pending)
+        self.pending_auth = None
+
+    @property
+    def tls_resumed(self):
+        return self.socket is not None and self.socket.session_reused
+
+    def connect(self, lazy_auth=False):
+        """Connect and authenticate.
+
+        The TLS session of an earlier connection to the same device is resumed when possible.  A bodyId
+        found by an earlier connection with the same credential is reused instead of repeating
+        bodyConfigSearch; otherwise bodyConfigSearch is pipelined behind bodyAuthenticate.  With
+        lazy_auth=True and a known bodyId, connect() returns without waiting for the auth reply, so the
+        first request is sent right behind it; the reply is checked by the next get_response()."""
+        self.open_socket()
+        self.authenticate(lazy=lazy_auth)
+
+    def open_socket(self):
+        self.decoder.reset()
+        self.store.clear()
+        self.pending_auth = None
+        self.socket = self.sm.get_socket((self.address, self.port))
+        self.socket.connect((self.address, self.port))
+        self._observe_connect()
+
+    def authenticate(self, lazy=False):
+        auth_id = self.send_request("bodyAuthenticate", self.credential.payload())
+        body_id = self.cached_body_id() if self.credential.cred_type == "MAK_CREDENTIAL" else None
+        if lazy and body_id is not None:
+            self.body_id = body_id
+            self.pending_auth = auth_id
+            return
+        config_id = None
+        if self.credential.cred_type == "MAK_CREDENTIAL" and body_id is None:
+            config_id = self.send_request("bodyConfigSearch", {"bodyId": "-"})
+        h, b = self.get_response(auth_id)
+        self.__finish_auth(b)
         if self.credential.cred_type == "WEB_CREDENTIAL":
-            try:
-                devices = [d for d in b["deviceId"] if d["friendlyName"] == self.credential.unit_name]
-                if len(devices) > 0:
-                    self.body_id = devices[0]["id"]
-                else:
-                    raise KeyError("No device entry matching unit_name.")
-            except KeyError:
-                self.body_id = "-"
+            self.body_id = self.web_body_id(b)
+        elif config_id is not None:
+            h, r = self.get_response(config_id)
+            self.body_id = self.config_body_id(r)
+            self.remember_body_id(self.body_id)
         else:
-            self.send_request("bodyConfigSearch", {"bodyId": "-"})
-            h, r = self.get_response()
-            try:
-                self.body_id = r['bodyConfig'][0]['bodyId']
-            except KeyError:
-                self.body_id = "-"
+            self.body_id = body_id
+
+    def __finish_auth(self, auth_response):
+        try:
+            self.check_auth(auth_response)
+        except MRPCError:
+            log.warning("Authentication with %s:%d failed: %r", self.address, self.port, auth_response)
+            self.close()
+            raise
+        self.sm.save_session((self.address, self.port), self.socket)
+
+    def _check_pending_auth(self):
+        auth_id, self.pending_auth = self.pending_auth, None
+        if auth_id is not None:
+            h, b = self.get_response(auth_id)
+            self.__finish_auth(b)
 
     def close(self):
-        if self.socket is not None:
-            self.socket.shutdown(socket.SHUT_RDWR)
-            self.socket.close()
-            self.socket = None
+        sock, self.socket = self.socket, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                # Already disconnected by the peer.
+                pass
+            sock.close()
+
+    def is_alive(self):
+        """Cheaply check, without a round trip, that an idle connection has not been closed by the peer.
+
+        Any replies that have arrived unread are moved into the frame decoder."""
+        if self.socket is None:
+            return False
+        try:
+            readable, _, _ = select.select([self.socket], [], [], 0)
+            if not readable:
+                return True
+            self.socket.setblocking(False)
+            try:
+                self.decoder.fill(self.socket)
+            finally:
+                self.socket.setblocking(True)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return True
+        except (OSError, ValueError, MRPCError):
+            return False
+        return True
+
+    def _deadline(self):
+        return None if self.timeout is None else time.monotonic() + self.timeout
 
     def send_request(self, req_type, payload_json, multiple_responses=False):
-        body_id = ""
-        if "bodyId" in payload_json:
-            body_id = payload_json["bodyId"]
-
-        header_tuples = (
-            ("Type", "request"),
-            ("RpcId", "{:d}".format(self.rpc_id)),
-            ("SchemaVersion", "{}".format(self.schema_version)),
-            ("Content-Type", "application/json"),
-            ("RequestType", req_type),
-            ("ResponseCount", self.response_count[multiple_responses]),
-            ("BodyId", body_id),
-            ("X-ApplicationName", "Quicksilver"),
-            ("X-ApplicationVersion", "1.2"),
-            ("X-ApplicationSessionId", "0x{:x}".format(self.session_id)),
-        )
-
-        headers = self.eol.join(["{}: {}".format(k, v) for k, v in header_tuples]) + self.eol
-
-        payload_json['type'] = req_type
-        payload = json.dumps(payload_json)
-        preamble = "MRPC/2 {:d} {:d}".format(len(headers) + 2, len(payload))
-        request = preamble + self.eol + headers + self.eol + payload + "\n"
-        self.rpc_id += 1
+        if self.observer is None:
+            rpc_id, request = self.encode_request(req_type, payload_json, multiple_responses)
+        else:
+            rpc_id, request = self._encode_observed(req_type, payload_json, multiple_responses)
+        self.store.add(rpc_id, deadline=self._deadline())
+        try:
+            self.socket.sendall(request)
+        except OSError:
+            self.store.pop(rpc_id)
+            raise
+        return rpc_id
 
-        self.socket.sendall(request.encode('ascii'))
-        return self.rpc_id - 1
+    def cancel(self, rpc_id):
+        """Abandon a request: its reply is dropped instead of being kept for get_response."""
+        self.store.cancel(rpc_id)
 
-    @staticmethod
-    def parse_headers(buffer):
-        return dict([line.split(': ', 1) for line in buffer.split('\r\n') if len(line) > 0])
+    def __read_frame(self, deadline):
+        if deadline is None:
+            return self.decoder.read_frame(self.socket)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout()
+        self.socket.settimeout(remaining)
+        try:
+            return self.decoder.read_frame(self.socket)
+        finally:
+            if self.socket is not None:
+                self.socket.settimeout(None)
 
-    def __get_response(self):
-        buffer = io.BytesIO()
-        buffer.write(self.socket.recv())
-        while b"\n" not in buffer.getvalue():
-            buffer.write(self.socket.recv())
-        buf_val = buffer.getvalue().decode()
-        m = self.proto_pat.search(buf_val)
-        h_size = int(m.groupdict()['h_size'])
-        b_size = int(m.groupdict()['b_size'])
-        h_start = m.span()[-1]
-        if self.debug:
-            print("RPC Response (Offset: {:d}, H Size: {:d}, B Size: {:d})".format(h_start, h_size, b_size))
-            print("RPC Response (Bytes Loaded: {:d})".format(buffer.tell() - h_start))
-        while buffer.tell() - h_start < h_size + b_size:
-            buffer.write(self.socket.recv())
+    def get_response(self, rpcid=None, timeout=-1):
+        """Return (headers, body) of the reply to rpcid, or of any outstanding request if rpcid is None.
+
+        timeout defaults to the time left before the request's deadline; None waits forever."""
+        if self.pending_auth is not None and rpcid != self.pending_auth:
+            self._check_pending_auth()
+        if rpcid is None:
+            rpcid_ready = self.store.first()
+            if rpcid_ready is not None:
+                return self.store.pop(rpcid_ready)
+        elif rpcid not in self.store:
+            raise MRPCError("No request outstanding with RpcId {:d}.".format(rpcid))
+        else:
+            reply = self.store.get(rpcid)
+            if reply is not None:
+                return self.store.pop(rpcid)
+        if timeout == -1:
+            deadline = None if rpcid is None else self.store.deadline(rpcid)
+        else:
+            deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                headers, body = self.__read_frame(deadline)
+            except socket.timeout:
+                if rpcid is not None:
+                    self.store.cancel(rpcid)
+                raise MRPCTimeout("No response to RpcId {} within the deadline.".format(rpcid))
             if self.debug:
-                print("RPC Response (Bytes Loaded: {:d})".format(buffer.tell() - h_start))
-        buf_val = buffer.getvalue().decode()
-        headers = self.parse_headers(buf_val[h_start:h_start+h_size])
-        if self.debug:
-            print("RPC Response ID: {}".format(headers['RpcId']))
-        response_json = json.loads(buf_val[h_start+h_size:])
-        return headers, response_json
-
-    def get_response(self, rpcid=None):
-        response = next((rsp for id, rsp in self.queue if id == rpcid or rpcid == None), None)
-        if response:
-            self.queue.remove((response[0]['RpcId'], response))
-            return response
-        headers, body = self.__get_response()
-        while int(headers['RpcId']) != rpcid and rpcid is not None:
-            self.queue.append((int(headers['RpcId']), (headers, body)))
-            headers, body = self.__get_response()
-        return headers, body
+                log.debug("RPC Response ID: %s", headers['RpcId'])
+            frame_id = int(headers['RpcId'])
+            if frame_id not in self.store:
+                self.store.set(frame_id, None)
+                self._observe_dropped(frame_id)
+                continue
+            reply = headers, self._decode_response(headers, body)
+            if rpcid is None or frame_id == rpcid:
+                self.store.pop(frame_id)
+                return reply
+            self.store.set(frame_id, reply)
+            self._observe_out_of_order(frame_id)
+
+    def subscribe(self, req_type, payload_json, callback=None):
+        raise MRPCError("Subscriptions need a reader that owns the connection; use a MultiplexedMRPCSession "
+                        "(multiplexed=True) or an AsyncMRPCSession.")
 
     def do_auth(self):
-        self.send_request("bodyAuthenticate", self.credential.payload())
-        h, b = self.get_response()
+        req_id = self.send_request("bodyAuthenticate", self.credential.payload())
+        h, b = self.get_response(req_id)
         try:
             return h, b
         except KeyError:
@@ -198,34 +786,251 @@ class MRPCSession(object):
         raise MRPCError("Auth Error, No Auth Status Response.")
 
     @staticmethod
-    def get_date_string(date_time):
-        return date_time.strftime("%Y-%m-%d %H:%M:%S")
-
-    @staticmethod
-    def new_session(cert_path, cert_password, address, credential, port=1413, debug=False):
-        sm = SocketMaker(cert_path=cert_path, cert_password=cert_password)
-        return MRPCSession(socket_maker=sm,
-                           address=address,
-                           credential=credential,
-                           port=port,
-                           debug=debug)
+    def new_session(cert_path, cert_password, address, credential, port=1413, debug=False, multiplexed=False):
+        sm = SocketMaker.shared(cert_path=cert_path, cert_password=cert_password)
+        session_class = MultiplexedMRPCSession if multiplexed else MRPCSession
+        return session_class(socket_maker=sm,
+                             address=address,
+                             credential=credential,
+                             port=port,
+                             debug=debug)
 
     @staticmethod
-    def new_local_session(cert_path, cert_password, address, mak, port=1413, debug=False):
+    def new_local_session(cert_path, cert_password, address, mak, port=1413, debug=False, multiplexed=False):
         cred = MRPCCredential.new_mak(mak=mak)
         return MRPCSession.new_session(cert_path=cert_path,
                                        cert_password=cert_password,
                                        address=address,
                                        credential=cred,
                                        port=port,
-                                       debug=debug)
+                                       debug=debug,
+                                       multiplexed=multiplexed)
 
     @staticmethod
-    def new_web_session(cert_path, cert_password, username, password, unit_name, debug=False):
+    def new_web_session(cert_path, cert_password, username, password, unit_name, debug=False, multiplexed=False):
         cred = MRPCCredential.new_web(username=username, password=password, unit_name=unit_name)
         return MRPCSession.new_session(cert_path=cert_path,
                                        cert_password=cert_password,
                                        address="middlemind.tivo.com",
                                        credential=cred,
                                        port=443,
-                                       debug=debug)
+                                       debug=debug,
+                                       multiplexed=multiplexed)
+
+
+class MRPCSubscription(object):
+    """A registration for a multi-response RPC such as tunerStateEventRegister.
+
+    Each response pushed on the subscription's RpcId is passed to callback(body) on the session's
+    reader thread if a callback was given, and otherwise queued for iteration; iterating blocks
+    until the next response arrives and stops once the subscription is cancelled, the device marks
+    a response IsFinal, or the connection fails (in which case the error is raised).  cancel()
+    stops delivery locally; responses the device still sends for the RpcId are discarded."""
+
+    __done = object()
+
+    def __init__(self, session, req_type, rpc_id, callback=None):
+        self.session = session
+        self.req_type = req_type
+        self.rpc_id = rpc_id
+        self.callback = callback
+        self.active = True
+        self.error = None
+        self.queue = queue.Queue()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.cancel()
+
+    def _deliver(self, headers, body):
+        if not self.active:
+            return
+        if self.callback is not None:
+            self.callback(body)
+        else:
+            self.queue.put(body)
+        if headers.get('IsFinal') == 'true':
+            self._finish()
+
+    def _finish(self, error=None):
+        if self.active:
+            self.active = False
+            self.error = error
+            self.queue.put(self.__done)
+
+    def cancel(self):
+        self.session.unsubscribe(self.rpc_id)
+        self._finish()
+
+    def get(self, timeout=None):
+        """Return the next response body, raising MRPCTimeout if none arrives within timeout seconds
+        and StopIteration once the subscription has ended."""
+        try:
+            body = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            raise MRPCTimeout("No event on RpcId {:d} within {} seconds.".format(self.rpc_id, timeout))
+        if body is self.__done:
+            self.queue.put(body)
+            if self.error is not None:
+                raise self.error
+            raise StopIteration
+        return body
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.get()
+            except StopIteration:
+                return
+
+
+class MultiplexedMRPCSession(MRPCSession):
+    """An MRPCSession that may be shared by many threads.
+
+    A background reader thread owns the receive side of the socket and hands each frame to the
+    thread waiting on its RpcId; sends are serialized under a lock.  get_response must be given
+    the id returned by send_request, and accepts a per-call timeout in seconds (defaulting to
+    the session's timeout, None meaning wait forever)."""
+
+    def __init__(self, socket_maker, address, credential, port=1413, debug=False, timeout=None, max_pending=256):
+        super().__init__(socket_maker, address, credential, port=port, debug=debug, timeout=timeout,
+                         max_pending=max_pending)
+        self.send_lock = threading.Lock()
+        self.subscriptions = {}
+        self.reader = None
+        self.failure = None
+
+    def open_socket(self):
+        super().open_socket()
+        self.failure = None
+        self.reader = threading.Thread(target=self.__read_loop,
+                                       name="MRPCReader-{}:{:d}".format(self.address, self.port),
+                                       daemon=True)
+        self.reader.start()
+
+    def close(self):
+        super().close()
+        reader, self.reader = self.reader, None
+        if reader is not None and reader is not threading.current_thread():
+            reader.join()
+        self.__fail_pending(MRPCError("Session closed."))
+
+    def is_alive(self):
+        reader = self.reader
+        return self.socket is not None and self.failure is None and reader is not None and reader.is_alive()
+
+    def __fail_pending(self, exc):
+        with self.send_lock:
+            self.failure = exc
+            futures = self.store.clear()
+            subscriptions, self.subscriptions = self.subscriptions, {}
+        for future in futures:
+            if future is not None and not future.done():
+                future.set_exception(exc)
+        for subscription in subscriptions.values():
+            subscription._finish(exc)
+
+    def __read_loop(self):
+        sock = self.socket
+        try:
+            while True:
+                headers, body = self.decoder.read_frame(sock)
+                if self.debug:
+                    log.debug("RPC Response ID: %s", headers['RpcId'])
+                rpc_id = int(headers['RpcId'])
+                subscription = self.subscriptions.get(rpc_id)
+                if subscription is not None:
+                    self.__deliver(subscription, headers, body)
+                    continue
+                future = self.store.get(rpc_id)
+                if future is None or future.done():
+                    self.store.dropped += 1
+                    self._observe_dropped(rpc_id)
+                    continue
+                try:
+                    future.set_result((headers, self._decode_response(headers, body)))
+                except ValueError as e:
+                    future.set_exception(MRPCError("Invalid response body: {}".format(e)))
+        except Exception as e:
+            # Whatever stops the reader, every waiting caller must hear of it.
+            self.__fail_pending(e if isinstance(e, MRPCError) else MRPCError(str(e) or repr(e)))
+
+    def __deliver(self, subscription, headers, body):
+        try:
+            subscription._deliver(headers, self._decode_response(headers, body))
+        except Exception as e:
+            # A failing callback must not stop the reader; it ends only its own subscription.
+            self.unsubscribe(subscription.rpc_id)
+            subscription._finish(e if isinstance(e, MRPCError) else MRPCError(repr(e)))
+        if not subscription.active:
+            self.unsubscribe(subscription.rpc_id)
+
+    def __send(self, req_type, payload_json, multiple_responses, register):
+        with self.send_lock:
+            if self.socket is None:
+                raise MRPCError("Session is not connected.")
+            if self.failure is not None:
+                raise self.failure
+            if self.observer is None:
+                rpc_id, request = self.encode_request(req_type, payload_json, multiple_responses)
+            else:
+                rpc_id, request = self._encode_observed(req_type, payload_json, multiple_responses)
+            registered = register(rpc_id)
+            try:
+                self.socket.sendall(request)
+            except OSError as e:
+                self.store.pop(rpc_id)
+                self.subscriptions.pop(rpc_id, None)
+                raise MRPCError(str(e))
+        return registered
+
+    def send_request(self, req_type, payload_json, multiple_responses=False):
+        # Room in the store is reserved before taking send_lock: a sender waiting for it while
+        # holding the lock would keep the reader from failing the session, hanging every caller.
+        self.store.reserve(timeout=self.timeout, failure=lambda: self.failure)
+        added = []
+
+        def register(rpc_id):
+            self.store.add(rpc_id, concurrent.futures.Future(), deadline=self._deadline(), reserved=True)
+            added.append(rpc_id)
+            return rpc_id
+        try:
+            return self.__send(req_type, payload_json, multiple_responses, register)
+        except Exception:
+            if not added:
+                self.store.release()
+            raise
+
+    def subscribe(self, req_type, payload_json, callback=None):
+        """Send a multi-response request and return the MRPCSubscription receiving its responses."""
+        def register(rpc_id):
+            subscription = MRPCSubscription(self, req_type, rpc_id, callback=callback)
+            self.subscriptions[rpc_id] = subscription
+            return subscription
+        return self.__send(req_type, payload_json, True, register)
+
+    def unsubscribe(self, rpc_id):
+        self.subscriptions.pop(rpc_id, None)
+
+    def get_response(self, rpcid=None, timeout=-1):
+        if rpcid is None:
+            raise ValueError("A multiplexed session requires the RpcId returned by send_request.")
+        if self.pending_auth is not None and rpcid != self.pending_auth:
+            self._check_pending_auth()
+        future = self.store.get(rpcid)
+        if future is None:
+            raise MRPCError("No request outstanding with RpcId {:d}.".format(rpcid))
+        if timeout == -1:
+            deadline = self.store.deadline(rpcid)
+            wait = None if deadline is None else max(deadline - time.monotonic(), 0)
+        else:
+            wait = timeout
+        try:
+            return future.result(timeout=wait)
+        except concurrent.futures.TimeoutError:
+            raise MRPCTimeout("No response to RpcId {:d} within {} seconds.".format(
+                rpcid, self.timeout if timeout == -1 else timeout))
+        finally:
+            self.store.pop(rpcid)
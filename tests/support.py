@@ -0,0 +1,64 @@
+import atexit
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import libtivomind.api as api
+import libtivomind.aio as aio
+import libtivomind.mockserver as mockserver
+import libtivomind.rpc as rpc
+
+_cert_path = None
+
+
+def certificate():
+    """Return a self-signed PEM certificate and key, made once per test run with openssl."""
+    global _cert_path
+    if _cert_path is None:
+        if shutil.which('openssl') is None:
+            raise unittest.SkipTest('The openssl command is needed to make a test certificate.')
+        directory = tempfile.mkdtemp(prefix='libtivomind-tests-')
+        atexit.register(shutil.rmtree, directory, True)
+        path = os.path.join(directory, 'cert.pem')
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                        '-subj', '/CN=localhost', '-keyout', path, '-out', path],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        _cert_path = path
+    return _cert_path
+
+
+class MockServerTestCase(unittest.TestCase):
+    """Starts MockMindServers on demand and opens sessions to them, closing everything afterwards."""
+
+    def setUp(self):
+        self.cert_path = certificate()
+        self.socket_maker = rpc.SocketMaker(self.cert_path, None)
+
+    def start_server(self, **options):
+        server = mockserver.MockMindServer(self.cert_path, **options)
+        server.start()
+        self.addCleanup(server.stop)
+        return server
+
+    def session(self, server, multiplexed=False, **options):
+        session_type = rpc.MultiplexedMRPCSession if multiplexed else rpc.MRPCSession
+        session = session_type(self.socket_maker, '127.0.0.1', rpc.MRPCCredential.new_mak('0'), port=server.port,
+                               **options)
+        session.connect()
+        self.addCleanup(session.close)
+        return session
+
+    def mind(self, server, multiplexed=False, session_options=None, **options):
+        return api.Mind(self.session(server, multiplexed=multiplexed, **(session_options or {})), **options)
+
+    async def async_mind(self, server, **options):
+        session = aio.AsyncMRPCSession(self.socket_maker, '127.0.0.1', rpc.MRPCCredential.new_mak('0'),
+                                       port=server.port)
+        await session.connect()
+        return aio.AsyncMind(session, **options)
+
+
+def offer_ids(count, start=0):
+    return ['tivo:of.{:d}'.format(i) for i in range(start, start + count)]
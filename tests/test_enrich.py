@@ -0,0 +1,52 @@
+import asyncio
+
+import libtivomind.cache as cache
+import libtivomind.records as records
+from tests.support import MockServerTestCase
+
+
+class EnrichTest(MockServerTestCase):
+
+    def test_enrich(self):
+        mind = self.mind(self.start_server(items=600))
+        offers = mind.offer_search(count=20)
+        enriched = mind.enrich(offers, collections=True, content=True)
+        self.assertEqual(len(enriched), 20)
+        for offer in enriched:
+            self.assertEqual(offer['collection']['collectionId'], offer['collectionId'])
+            self.assertEqual(offer['content']['contentId'], offer['contentId'])
+        self.assertTrue(all('collection' not in o and 'content' not in o for o in offers))
+
+    def test_enrich_leaves_cached_results_unchanged(self):
+        response_cache = cache.ResponseCache()
+        mind = self.mind(self.start_server(items=100), cache=response_cache)
+        enriched = mind.enrich(mind.offer_search(count=10))
+        self.assertIn('collection', enriched[0])
+        cached = mind.offer_search(count=10)
+        self.assertEqual(response_cache.stats()['hits'], 1)
+        self.assertTrue(all('collection' not in o for o in cached))
+
+    def test_enrich_compact_records(self):
+        mind = self.mind(self.start_server(items=100, item_size=20), compact=True)
+        offers = mind.offer_search(count=5)
+        offers[0]['description']
+        enriched = mind.enrich(offers)
+        self.assertIsInstance(enriched[0], records.Offer)
+        self.assertEqual(enriched[0].collection['collectionId'], offers[0].collectionId)
+        self.assertNotIn('collection', offers[0])
+
+    def test_async_enrich(self):
+        server = self.start_server(items=100)
+
+        async def run():
+            mind = await self.async_mind(server, cache=cache.ResponseCache())
+            try:
+                offers = await mind.offer_search(count=10)
+                enriched = await mind.enrich(offers, content=True)
+                return enriched, await mind.offer_search(count=10)
+            finally:
+                await mind.close()
+
+        enriched, cached = asyncio.run(run())
+        self.assertTrue(all('collection' in o and 'content' in o for o in enriched))
+        self.assertTrue(all('collection' not in o for o in cached))
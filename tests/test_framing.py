@@ -0,0 +1,115 @@
+import json
+import unittest
+
+import libtivomind.rpc as rpc
+from tests.support import MockServerTestCase
+
+
+def frame(rpc_id, body):
+    body = json.dumps(body).encode()
+    headers = 'Type: response\r\nRpcId: {:d}\r\nIsFinal: true\r\n\r\n'.format(rpc_id).encode()
+    return b'MRPC/2 ' + str(len(headers)).encode() + b' ' + str(len(body)).encode() + b'\r\n' + headers + body
+
+
+class ChunkedSocket(object):
+    """Hands out the given chunks of bytes, one per recv_into call."""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv_into(self, buffer):
+        if not self.chunks:
+            return 0
+        chunk = self.chunks.pop(0)
+        if len(chunk) > len(buffer):
+            chunk, rest = chunk[:len(buffer)], chunk[len(buffer):]
+            self.chunks.insert(0, rest)
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+
+class FrameDecoderTest(unittest.TestCase):
+
+    def test_frame_split_at_every_byte(self):
+        data = frame(7, {'offer': [{'offerId': 'tivo:of.1'}]})
+        decoder = rpc.MRPCFrameDecoder()
+        headers, body = decoder.read_frame(ChunkedSocket(data[i:i + 1] for i in range(len(data))))
+        self.assertEqual(headers['RpcId'], '7')
+        self.assertEqual(json.loads(body), {'offer': [{'offerId': 'tivo:of.1'}]})
+        self.assertEqual(headers.b_size, len(body))
+        self.assertEqual(decoder.pending, 0)
+
+    def test_debug_logs_frames(self):
+        decoder = rpc.MRPCFrameDecoder(debug=True)
+        with self.assertLogs('libtivomind.rpc', 'DEBUG') as logs:
+            decoder.read_frame(ChunkedSocket([frame(3, {})]))
+        self.assertIn('RPC Response (Bytes Loaded', logs.output[-1])
+
+    def test_coalesced_frames(self):
+        data = b''.join(frame(i, {'n': i}) for i in range(5))
+        decoder = rpc.MRPCFrameDecoder()
+        decoder.feed(data[:-3])
+        frames = []
+        while True:
+            next_frame = decoder.next_frame()
+            if next_frame is None:
+                break
+            frames.append(next_frame)
+        self.assertEqual([int(h['RpcId']) for h, b in frames], [0, 1, 2, 3])
+        decoder.feed(data[-3:])
+        headers, body = decoder.next_frame()
+        self.assertEqual(json.loads(body), {'n': 4})
+        self.assertIsNone(decoder.next_frame())
+
+    def test_buffer_grows_for_large_frames(self):
+        data = frame(1, {'description': 'x' * 200000})
+        decoder = rpc.MRPCFrameDecoder(buffer_size=1024)
+        headers, body = decoder.read_frame(ChunkedSocket(data[i:i + 5000] for i in range(0, len(data), 5000)))
+        self.assertEqual(len(json.loads(body)['description']), 200000)
+
+    def test_closed_connection(self):
+        decoder = rpc.MRPCFrameDecoder()
+        with self.assertRaises(rpc.MRPCError):
+            decoder.read_frame(ChunkedSocket([frame(1, {})[:10]]))
+
+    def test_encode_request_round_trip(self):
+        protocol = rpc.MRPCProtocol(None, '127.0.0.1', rpc.MRPCCredential.new_mak('0'))
+        payload = {'bodyId': 'tsn:1', 'count': 5}
+        rpc_id, request = protocol.encode_request('offerSearch', payload, multiple_responses=True)
+        decoder = rpc.MRPCFrameDecoder()
+        decoder.feed(request)
+        headers, body = decoder.next_frame()
+        self.assertEqual(int(headers['RpcId']), rpc_id)
+        self.assertEqual(headers['RequestType'], 'offerSearch')
+        self.assertEqual(headers['ResponseCount'], 'multiple')
+        self.assertEqual(headers['BodyId'], 'tsn:1')
+        self.assertEqual(json.loads(body), {'bodyId': 'tsn:1', 'count': 5, 'type': 'offerSearch'})
+        self.assertNotIn('type', payload)
+        self.assertEqual(protocol.encode_request('offerSearch', payload)[0], rpc_id + 1)
+
+
+class SessionFramingTest(MockServerTestCase):
+
+    def test_round_trip(self):
+        server = self.start_server(items=30)
+        session = self.session(server)
+        self.assertEqual(session.body_id, server.body_id)
+        rpc_id = session.send_request('channelSearch', {'bodyId': session.body_id, 'count': 10})
+        headers, body = session.get_response(rpc_id)
+        self.assertEqual(int(headers['RpcId']), rpc_id)
+        self.assertEqual(len(body['channel']), 10)
+
+    def test_out_of_order_replies_are_kept(self):
+        server = self.start_server(items=100, jitter=0.05)
+        session = self.session(server)
+        ids = [session.send_request('offerSearch', {'count': 1, 'offset': i}) for i in range(10)]
+        for i, rpc_id in reversed(list(enumerate(ids))):
+            headers, body = session.get_response(rpc_id)
+            self.assertEqual(body['offer'][0]['offerId'], 'tivo:of.{:d}'.format(i))
+        self.assertEqual(len(session.store), 0)
+
+    def test_failed_authentication(self):
+        server = self.start_server(mak='1234')
+        with self.assertRaises(rpc.MRPCError), self.assertLogs('libtivomind.rpc', 'WARNING') as logs:
+            self.session(server)
+        self.assertNotIn('makCredential', ''.join(logs.output))
@@ -0,0 +1,45 @@
+import datetime
+
+import libtivomind.api as api
+import libtivomind.guide as guide
+from tests.support import MockServerTestCase, offer_ids
+
+
+class GuideIndexTest(MockServerTestCase):
+
+    def index(self, server):
+        index = guide.GuideIndex(self.mind(server), window_size=3600, page_size=50)
+        self.addCleanup(index.close)
+        return index
+
+    def test_sync_and_query(self):
+        server = self.start_server(items=200, stations=20)
+        index = self.index(server)
+        end = server.epoch + datetime.timedelta(hours=6)
+        self.assertEqual(index.sync(server.epoch, end), 200)
+        self.assertEqual(index.sync(server.epoch, end), 0)
+        offers = index.offer_search()
+        self.assertEqual({o['offerId'] for o in offers}, set(offer_ids(200)))
+        self.assertEqual([o['startTime'] for o in offers], sorted(o['startTime'] for o in offers))
+        filt = api.SearchFilter()
+        filt.by_collection_id(['tivo:cl.3', 'tivo:cl.4'])
+        self.assertEqual({o['offerId'] for o in index.offer_search(filt)}, {'tivo:of.3', 'tivo:of.4'})
+
+    def test_sync_rejects_narrowing_filters(self):
+        server = self.start_server(items=200, stations=20)
+        index = self.index(server)
+        end = server.epoch + datetime.timedelta(hours=6)
+        index.sync(server.epoch, end)
+        filt = api.SearchFilter()
+        filt.by_station_id('tivo:st.1')
+        with self.assertRaises(ValueError):
+            index.sync(server.epoch, end, max_age=-1, filt=filt)
+        self.assertEqual(len(index.offer_search()), 200)
+        detail = api.SearchFilter()
+        detail.set_level_of_detail('low')
+        self.assertEqual(index.sync(server.epoch, end, max_age=-1, filt=detail), 200)
+
+    def test_list_filter_rejected_for_ranges(self):
+        index = self.index(self.start_server(items=10))
+        with self.assertRaises(ValueError):
+            index.offer_search({'titleKeyword': ['a', 'b']})
@@ -0,0 +1,54 @@
+import libtivomind.api as api
+import libtivomind.library as library
+from tests.support import MockServerTestCase
+
+
+class RecordingLibraryTest(MockServerTestCase):
+
+    def library(self, server):
+        lib = library.RecordingLibrary(self.mind(server), page_size=100, batch_size=100)
+        self.addCleanup(lib.close)
+        return lib
+
+    def test_sync(self):
+        server = self.start_server(items=300)
+        lib = self.library(server)
+        changes = lib.sync()
+        self.assertEqual(len(changes), 600)
+        self.assertEqual({c.action for c in changes}, {'added'})
+        self.assertEqual(lib.get('recording', 'tivo:rc.7')['recordingId'], 'tivo:rc.7')
+        self.assertEqual(lib.sync(), [])
+        server.items = 250
+        changes = lib.sync(kinds=['recording'])
+        self.assertEqual(sorted(c.item_id for c in changes if c.action == 'removed'),
+                         sorted('tivo:rc.{:d}'.format(i) for i in range(250, 300)))
+        self.assertEqual(len(lib.items('recording')), 250)
+
+    def test_subscribers(self):
+        lib = self.library(self.start_server(items=20))
+        seen = []
+        lib.subscribe(seen.append)
+        lib.sync(kinds=['recording'])
+        lib.unsubscribe(seen.append)
+        lib.sync(kinds=['recording'])
+        self.assertEqual(len(seen), 20)
+
+    def test_filtered_sync_keeps_unlisted_items(self):
+        server = self.start_server(items=2000)
+        lib = self.library(server)
+        lib.sync(kinds=['recordingFolderItem'])
+        filt = api.SearchFilter()
+        filt.by_recording_folder_item_id('tivo:rf.5')
+        self.assertEqual(lib.sync(kinds=['recordingFolderItem'], filt=filt), [])
+        self.assertEqual(len(lib.items('recordingFolderItem')), 2000)
+
+    def test_filtered_sync_removes_named_items(self):
+        server = self.start_server(items=2000)
+        lib = self.library(server)
+        lib.sync(kinds=['recordingFolderItem'])
+        server.items = 1000
+        filt = api.SearchFilter()
+        filt.by_recording_folder_item_id(['tivo:rf.5', 'tivo:rf.1500'])
+        changes = lib.sync(kinds=['recordingFolderItem'], filt=filt)
+        self.assertEqual([(c.action, c.item_id) for c in changes], [('removed', 'tivo:rf.1500')])
+        self.assertEqual(len(lib.items('recordingFolderItem')), 1999)
@@ -0,0 +1,115 @@
+import concurrent.futures
+import threading
+import time
+
+import libtivomind.api as api
+import libtivomind.instrument as instrument
+import libtivomind.rpc as rpc
+from tests.support import MockServerTestCase, offer_ids
+
+
+class MultiplexedSessionTest(MockServerTestCase):
+
+    def test_concurrent_callers(self):
+        server = self.start_server(items=400, jitter=0.01)
+        mind = self.mind(server, multiplexed=True, page_window=2)
+        with concurrent.futures.ThreadPoolExecutor(8) as pool:
+            futures = [pool.submit(mind.offer_search, count=10, offset=i * 10) for i in range(16)]
+            futures.append(pool.submit(mind.offer_search, count=25, fetch_all=True))
+            pages = [f.result(timeout=10) for f in futures]
+        for i, page in enumerate(pages[:-1]):
+            self.assertEqual([o['offerId'] for o in page], offer_ids(10, i * 10))
+        self.assertEqual([o['offerId'] for o in pages[-1]], offer_ids(400))
+        self.assertEqual(len(mind.session.store), 0)
+
+    def test_requires_rpc_id(self):
+        session = self.session(self.start_server(), multiplexed=True)
+        with self.assertRaises(ValueError):
+            session.get_response()
+
+    def test_subscription(self):
+        server = self.start_server(event_count=3, event_interval=0.02)
+        session = self.session(server, multiplexed=True)
+        with session.subscribe('tunerStateEventRegister', {'bodyId': session.body_id}) as subscription:
+            sequences = [body['state'][0]['sequence'] for _, body in zip(range(4), subscription)]
+        self.assertEqual(sequences, [0, 1, 2, 3])
+        self.assertEqual(len(api.Mind(session).channel_search(count=3)), 3)
+
+    def test_lost_connection_fails_waiting_callers(self):
+        server = self.start_server(latency=1.0)
+        session = self.session(server, multiplexed=True)
+        rpc_ids = [session.send_request('channelSearch', {'count': 1}) for _ in range(3)]
+        server.stop()
+        for rpc_id in rpc_ids:
+            with self.assertRaises(rpc.MRPCError):
+                session.get_response(rpc_id, timeout=5)
+        self.assertFalse(session.is_alive())
+        with self.assertRaises(rpc.MRPCError):
+            session.send_request('channelSearch', {'count': 1})
+
+    def test_lost_connection_with_full_store(self):
+        # A sender waiting for room must not keep the reader from failing the session.
+        server = self.start_server(latency=1.0)
+        session = self.session(server, multiplexed=True, max_pending=2)
+        mind = api.Mind(session)
+        errors = []
+
+        def search():
+            try:
+                mind.offer_search(count=10)
+            except rpc.MRPCError as e:
+                errors.append(e)
+        threads = [threading.Thread(target=search, daemon=True) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.3)
+        server.stop()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(errors), 3)
+        self.assertIsNotNone(session.failure)
+        started = time.monotonic()
+        session.close()
+        self.assertLess(time.monotonic() - started, 2)
+
+    def test_close_fails_waiting_callers(self):
+        server = self.start_server(latency=5.0)
+        session = self.session(server, multiplexed=True)
+        rpc_id = session.send_request('channelSearch', {'count': 1})
+        closer = threading.Timer(0.1, session.close)
+        closer.start()
+        with self.assertRaises(rpc.MRPCError):
+            session.get_response(rpc_id, timeout=5)
+        closer.join()
+
+    def test_reader_failure_fails_waiting_callers(self):
+        server = self.start_server()
+        session = self.session(server, multiplexed=True)
+
+        def broken(event):
+            raise KeyError('observer bug')
+        session.observer = instrument.CallbackObserver(on_response=broken)
+        rpc_id = session.send_request('channelSearch', {'count': 1})
+        with self.assertRaises(rpc.MRPCError):
+            session.get_response(rpc_id, timeout=5)
+        session.reader.join(5)
+        self.assertFalse(session.is_alive())
+        with self.assertRaises(rpc.MRPCError):
+            session.send_request('channelSearch', {'count': 1})
+
+    def test_concurrent_close(self):
+        session = self.session(self.start_server(), multiplexed=True)
+        errors = []
+
+        def close():
+            try:
+                session.close()
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=close) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(errors, [])
+        self.assertFalse(session.is_alive())
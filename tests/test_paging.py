@@ -0,0 +1,132 @@
+import asyncio
+import unittest
+
+import libtivomind.api as api
+import libtivomind.paging as paging
+import libtivomind.rpc as rpc
+from tests.support import MockServerTestCase, offer_ids
+
+
+class PageWindowTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cancelled = []
+        self.pages = paging.PageWindow({}, self.cancelled.append, count=10, offset=5, window=3)
+
+    def send(self):
+        sent = []
+        while self.pages.wants():
+            sent.append((dict(self.pages.request()), len(sent)))
+            self.pages.sent(sent[-1][1])
+        return sent
+
+    def test_window(self):
+        sent = self.send()
+        self.assertEqual([(p['offset'], p['count']) for p, rpc_id in sent], [(5, 10), (15, 10), (25, 10)])
+        self.assertEqual(self.pages.next_id(), 0)
+        self.assertFalse(self.pages.received(None, {'isBottom': False}, list(range(10))))
+        self.assertEqual(self.pages.request()['offset'], 35)
+
+    def test_short_page_resumes_at_actual_offset(self):
+        self.send()
+        self.pages.next_id()
+        self.assertFalse(self.pages.received(None, {'isBottom': False}, list(range(7))))
+        self.assertEqual(self.cancelled, [1, 2])
+        self.assertEqual(self.pages.request()['offset'], 12)
+
+    def test_bottom_cancels_over_fetched_pages(self):
+        self.send()
+        self.pages.next_id()
+        self.assertTrue(self.pages.received(None, {'isBottom': True}, list(range(10))))
+        self.assertEqual(self.cancelled, [1, 2])
+        self.assertFalse(self.pages.wants())
+
+    def test_sizer_sets_count(self):
+        sizer = paging.AdaptivePageSizer(target_latency=None, target_bytes=None, min_count=10, max_count=40)
+        pages = paging.PageWindow({}, self.cancelled.append, count=100, sizer=sizer, key='offerSearch')
+        self.assertEqual(pages.request()['count'], 40)
+
+
+class PagingTest(MockServerTestCase):
+
+    def test_single_page(self):
+        mind = self.mind(self.start_server(items=100))
+        self.assertEqual([o['offerId'] for o in mind.offer_search(count=10, offset=5)], offer_ids(10, 5))
+
+    def test_fetch_all(self):
+        mind = self.mind(self.start_server(items=105))
+        self.assertEqual([o['offerId'] for o in mind.offer_search(count=10, fetch_all=True)], offer_ids(105))
+
+    def test_pipelined_fetch_all(self):
+        server = self.start_server(items=333, jitter=0.01)
+        for multiplexed in (False, True):
+            session = self.session(server, multiplexed=multiplexed)
+            mind = api.Mind(session, page_window=4)
+            self.assertEqual([o['offerId'] for o in mind.offer_search(count=20, fetch_all=True)], offer_ids(333))
+            self.assertEqual(len(session.store), 0)
+
+    def test_pipelined_short_page_resumes_at_actual_offset(self):
+        # A filtered search whose matches run out mid-page must not skip or repeat results.
+        server = self.start_server(items=500)
+        mind = self.mind(server, page_window=3)
+        filt = api.SearchFilter()
+        filt.by_start_time(max_utc_time=server.epoch.replace(hour=2))
+        offers = mind.offer_search(filt=filt, count=30, fetch_all=True)
+        self.assertEqual([o['offerId'] for o in offers], offer_ids(250))
+
+    def test_resumable_fetch_all(self):
+        server = self.start_server(items=1000, disconnect_after=6)
+        policy = paging.RetryPolicy(base_delay=0.01)
+        for window in (1, 4):
+            mind = self.mind(server, page_window=window, retry=policy)
+            self.assertEqual([o['offerId'] for o in mind.offer_search(count=50, fetch_all=True)], offer_ids(1000))
+        self.assertGreater(policy.stats()['resumes'], 0)
+
+    def test_resumable_fetch_all_gives_up(self):
+        server = self.start_server(items=1000, disconnect_after=3)
+        policy = paging.RetryPolicy(max_retries=2, base_delay=0.01)
+        mind = self.mind(server, retry=policy)
+        server.mak = 'other'
+        with self.assertRaises(rpc.MRPCError):
+            mind.offer_search(count=50, fetch_all=True)
+        self.assertEqual(policy.stats()['retries'], 2)
+
+    def test_adaptive_page_size(self):
+        server = self.start_server(items=2000, item_size=500)
+        for window in (1, 4):
+            sizer = paging.AdaptivePageSizer(target_bytes=64 * 1024)
+            mind = self.mind(server, page_window=window, page_sizer=sizer)
+            self.assertEqual([o['offerId'] for o in mind.offer_search(count=10, fetch_all=True)], offer_ids(2000))
+            self.assertGreater(list(sizer.sizes().values())[0], 10)
+
+    def test_streamed(self):
+        server = self.start_server(items=234)
+        for window in (1, 3):
+            mind = self.mind(server, page_window=window)
+            self.assertEqual([o['offerId'] for o in mind.iter_offers(count=25)], offer_ids(234))
+
+    def test_streamed_close_cancels_prefetched_pages(self):
+        server = self.start_server(items=1000)
+        session = self.session(server)
+        mind = api.Mind(session, page_window=4)
+        results = mind.iter_offers(count=10)
+        self.assertEqual([next(results)['offerId'] for _ in range(15)], offer_ids(15))
+        results.close()
+        self.assertEqual(len(session.store), 0)
+        self.assertEqual(len(mind.channel_search(count=5)), 5)
+
+    def test_async_paging(self):
+        server = self.start_server(items=321, jitter=0.005)
+
+        async def run():
+            mind = await self.async_mind(server, page_window=4)
+            try:
+                offers = await mind.offer_search(count=25, fetch_all=True)
+                streamed = [o['offerId'] async for o in mind.iter_offers(count=25)]
+            finally:
+                await mind.close()
+            return [o['offerId'] for o in offers], streamed
+
+        offers, streamed = asyncio.run(run())
+        self.assertEqual(offers, offer_ids(321))
+        self.assertEqual(streamed, offer_ids(321))
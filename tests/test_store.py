@@ -0,0 +1,105 @@
+import threading
+import time
+import unittest
+
+import libtivomind.api as api
+import libtivomind.rpc as rpc
+from tests.support import MockServerTestCase
+
+
+class ResponseStoreTest(unittest.TestCase):
+
+    def test_set_and_pop(self):
+        store = rpc.MRPCResponseStore()
+        store.add(1)
+        self.assertIn(1, store)
+        self.assertIsNone(store.first())
+        self.assertTrue(store.set(1, 'reply'))
+        self.assertEqual(store.first(), 1)
+        self.assertEqual(store.pop(1), 'reply')
+        self.assertNotIn(1, store)
+
+    def test_reply_for_unknown_request_is_dropped(self):
+        store = rpc.MRPCResponseStore()
+        self.assertFalse(store.set(9, 'late'))
+        store.add(1)
+        store.cancel(1)
+        self.assertFalse(store.set(1, 'late'))
+        self.assertEqual(store.stats()['dropped'], 2)
+        self.assertEqual(store.stats()['cancelled'], 1)
+
+    def test_bound(self):
+        store = rpc.MRPCResponseStore(max_size=2)
+        store.add(1)
+        store.add(2)
+        started = time.monotonic()
+        with self.assertRaises(rpc.MRPCError):
+            store.add(3, timeout=0.1)
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+        threading.Timer(0.05, store.pop, (1,)).start()
+        store.add(3, timeout=5)
+        self.assertEqual(store.stats()['max_depth'], 2)
+
+    def test_expired_requests_make_room(self):
+        store = rpc.MRPCResponseStore(max_size=1)
+        store.add(1, deadline=time.monotonic() - 1)
+        store.add(2)
+        self.assertNotIn(1, store)
+        self.assertEqual(store.stats()['expired'], 1)
+
+    def test_reserve(self):
+        store = rpc.MRPCResponseStore(max_size=2)
+        store.reserve()
+        store.add(1)
+        with self.assertRaises(rpc.MRPCError):
+            store.reserve(timeout=0)
+        store.release()
+        store.reserve()
+        store.add(2, reserved=True)
+        self.assertEqual(len(store), 2)
+
+    def test_reserve_stops_waiting_on_failure(self):
+        store = rpc.MRPCResponseStore(max_size=1)
+        store.add(1)
+        failure = []
+        threading.Timer(0.05, lambda: (failure.append(rpc.MRPCError('Connection lost.')), store.clear())).start()
+        with self.assertRaises(rpc.MRPCError) as raised:
+            store.reserve(timeout=5, failure=lambda: failure[0] if failure else None)
+        self.assertEqual(str(raised.exception), 'Connection lost.')
+
+
+class SessionStoreTest(MockServerTestCase):
+
+    def test_timeout(self):
+        server = self.start_server(latency=0.5)
+        session = self.session(server, timeout=2)
+        session.timeout = 0.1
+        rpc_id = session.send_request('channelSearch', {'count': 1})
+        with self.assertRaises(rpc.MRPCTimeout):
+            session.get_response(rpc_id)
+        self.assertNotIn(rpc_id, session.store)
+        # The late reply is dropped and the session keeps working.
+        session.timeout = 2
+        headers, body = session.get_response(session.send_request('channelSearch', {'count': 2}))
+        self.assertEqual(len(body['channel']), 2)
+        self.assertEqual(session.store.stats()['dropped'], 1)
+
+    def test_cancel(self):
+        server = self.start_server()
+        session = self.session(server)
+        cancelled = session.send_request('channelSearch', {'count': 1})
+        session.cancel(cancelled)
+        kept = session.send_request('channelSearch', {'count': 3})
+        headers, body = session.get_response(kept)
+        self.assertEqual(len(body['channel']), 3)
+        with self.assertRaises(rpc.MRPCError):
+            session.get_response(cancelled)
+
+    def test_multiplexed_timeout(self):
+        server = self.start_server(latency=0.5)
+        session = self.session(server, multiplexed=True)
+        rpc_id = session.send_request('channelSearch', {'count': 1})
+        with self.assertRaises(rpc.MRPCTimeout):
+            session.get_response(rpc_id, timeout=0.1)
+        self.assertNotIn(rpc_id, session.store)
+        self.assertEqual(len(api.Mind(session).channel_search(count=4)), 4)